@@ -1,14 +1,71 @@
 import os
+import sys
+import types
+import pickle
 import logging
-import numpy as np
-import pandas as pd
-from typing import Tuple
+import tempfile
+import threading
+import contextlib
+import importlib.util
+from typing import Dict, Tuple, Optional
 from itertools import cycle
 from logging.handlers import RotatingFileHandler
 
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Importing the module on the first access to its attributes, so that heavy modules are loaded only when needed.
+    :param name:
+    :return:
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec: importlib.machinery.ModuleSpec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module: types.ModuleType = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+LAZY_IMPORT_LOCK: threading.Lock = threading.Lock()
+
+
+def reset_lazy_import_lock() -> None:
+    """
+    Dropping the lock inherited from the parent process, it may be held by its thread.
+    :return:
+    """
+    global LAZY_IMPORT_LOCK
+    LAZY_IMPORT_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_lazy_import_lock)
+
+
+def load_modules(*modules: types.ModuleType) -> None:
+    """
+    Loading the lazily imported modules under the lock. The lazy loader is not thread-safe,
+    so the modules must be loaded before the threads that use them are started.
+    :param modules:
+    :return:
+    """
+    with LAZY_IMPORT_LOCK:
+        for module in modules:
+            getattr(module, "__dict__")
+
+
+np: types.ModuleType = lazy_import("numpy")
+pd: types.ModuleType = lazy_import("pandas")
+
 LOG_FORMAT: str = "[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s"
 DATE_FTM: str = "%d/%B/%Y %H:%M:%S"
-WAITING_TIME: int = 300
+WAITING_TIME: int = int(os.environ.get("XL_IDP_WAITING_TIME", 300))
+POLL_INTERVAL: int = int(os.environ.get("XL_IDP_POLL_INTERVAL", 5))
+CLOSED_WAITING_TIME: int = int(os.environ.get("XL_IDP_CLOSED_WAITING_TIME", 2))
+WATCH_MODE: str = os.environ.get("XL_IDP_WATCH_MODE", "inotify")
+WORKERS: int = int(os.environ.get("XL_IDP_WORKERS", os.cpu_count() or 1))
+MAX_QUEUED_WORKBOOKS: int = int(os.environ.get("XL_IDP_MAX_QUEUED_WORKBOOKS", 2 * WORKERS))
 
 # os.environ["XL_IDP_ROOT_UNZIPPING"] = "."
 # os.environ["XL_IDP_PATH_UNZIPPING"] = "/home/timur/sambashare/unzipping/upload"
@@ -21,7 +78,49 @@ DESTINATION_STATION_LABELS: Tuple = (
     "Address/ Адрес/"
 )
 
+CONFIG_SHEETS: Tuple = ("labels_before_table", "headers_table", "station")
 BASE_DIRECTORIES: list = ["errors_excel", "done", "archives", "json", "done_excel", "errors"]
+EXCEL_EXTENSIONS: Tuple = (".xlsx", ".xls")
+MAX_IN_MEMORY_SIZE: int = int(os.environ.get("XL_IDP_MAX_IN_MEMORY_SIZE", 64 * pow(1024, 2)))
+ARCHIVE_EXTENSIONS: Tuple = (".zip", ".rar", ".7z")
+MAX_ARCHIVE_DEPTH: int = int(os.environ.get("XL_IDP_MAX_ARCHIVE_DEPTH", 5))
+MAX_MEMBERS_COUNT: int = int(os.environ.get("XL_IDP_MAX_MEMBERS_COUNT", 10000))
+MAX_UNCOMPRESSED_SIZE: int = int(os.environ.get("XL_IDP_MAX_UNCOMPRESSED_SIZE", 10 * pow(1024, 3)))
+CHUNK_SIZE: int = pow(1024, 2)
+SHEET_SCAN_ROWS: int = 30
+EXCEL_READER: str = os.environ.get("XL_IDP_EXCEL_READER", "pandas")
+# Strings read by pandas as NaN (the default na_values of pandas 2.0) and NaT, the stream reader replaces them with None
+NA_VALUES: frozenset = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA",
+    "NULL", "NaN", "None", "n/a", "nan", "null", "NaT"
+})
+OUTPUT_FORMAT: str = os.environ.get("XL_IDP_OUTPUT_FORMAT", "json")
+ITEM_COLUMNS: Tuple = ("tnved_code",)
+WORKBOOK_CACHE_MAX_RECORDS: int = int(os.environ.get("XL_IDP_WORKBOOK_CACHE_MAX_RECORDS", 10000))
+WORKBOOK_CACHE_TTL: int = int(os.environ.get("XL_IDP_WORKBOOK_CACHE_TTL", 604800))
+OUTPUT_BATCH: str = os.environ.get("XL_IDP_OUTPUT_BATCH", "workbook")
+ROWS_CHUNK_SIZE: int = int(os.environ.get("XL_IDP_ROWS_CHUNK_SIZE", 1000))
+NORMALIZED_CELLS_CACHE_SIZE: int = int(os.environ.get("XL_IDP_NORMALIZED_CELLS_CACHE_SIZE", 65536))
+COMPANY_LOOKUP_WORKERS: int = int(os.environ.get("XL_IDP_COMPANY_LOOKUP_WORKERS", 4))
+PREFETCH_COMPANIES: bool = os.environ.get("XL_IDP_PREFETCH_COMPANIES", "0") == "1"
+PREFETCH_QUEUE_SIZE: int = int(os.environ.get("XL_IDP_PREFETCH_QUEUE_SIZE", 32))
+PREFETCH_WORKERS: int = int(os.environ.get("XL_IDP_PREFETCH_WORKERS", 16))
+HTTP_KEEPALIVE_EXPIRY: float = float(os.environ.get("XL_IDP_HTTP_KEEPALIVE_EXPIRY", 60))
+COMPANY_CACHE_SIZE: int = int(os.environ.get("XL_IDP_COMPANY_CACHE_SIZE", 10000))
+# Seconds, for which found and not found companies are kept in the cache: (found, not found).
+COMPANY_CACHE_TTL: Dict[str, Tuple[int, int]] = {
+    country: (
+        int(os.environ.get(f"XL_IDP_COMPANY_CACHE_TTL_{country.upper()}", ttl)),
+        int(os.environ.get(f"XL_IDP_COMPANY_CACHE_NEGATIVE_TTL_{country.upper()}", negative_ttl))
+    )
+    for country, ttl, negative_ttl in (
+        ("russia", 30 * 86400, 86400),
+        ("kazakhstan", 30 * 86400, 86400),
+        ("belarus", 30 * 86400, 86400),
+        ("uzbekistan", 30 * 86400, 86400),
+        ("search_engine", 7 * 86400, 86400)
+    )
+}
 
 USER_XML_RIVER: str = "6390"
 KEY_XML_RIVER: str = "e3b3ac2908b2a9e729f1671218c85e12cfe643b0"
@@ -92,6 +191,20 @@ def get_logger(name: str) -> logging.getLogger:
     return logger
 
 
+class LazyLogger:
+    """
+    Logger of a module that creates the log file and the handlers on the first message.
+    """
+    def __init__(self, name: str):
+        self.name: str = name
+        self.logger: Optional[logging.Logger] = None
+
+    def __getattr__(self, item: str):
+        if self.logger is None:
+            self.logger = get_logger(self.name)
+        return getattr(self.logger, item)
+
+
 def read_config_table(sheet):
     df = pd.read_excel(
         f"{get_my_env_var('XL_IDP_ROOT_UNZIPPING')}/unzipping_table.xlsx",
@@ -106,11 +219,59 @@ def read_config_table(sheet):
     }
 
 
+def load_config() -> dict:
+    """
+    Loading the config tables and their indexes from the snapshot in the cache directory.
+    The snapshot is rebuilt from unzipping_table.xlsx when the size or the mtime of the table changes.
+    """
+    root_directory: str = get_my_env_var('XL_IDP_ROOT_UNZIPPING')
+    stat: os.stat_result = os.stat(f"{root_directory}/unzipping_table.xlsx")
+    key: Tuple[int, int] = (stat.st_mtime_ns, stat.st_size)
+    snapshot_path: str = f"{root_directory}/cache/config.pickle"
+    with contextlib.suppress(Exception):
+        with open(snapshot_path, "rb") as f:
+            config: dict = pickle.load(f)
+        if config["key"] == key:
+            return config
+
+    config: dict = {"key": key}
+    for sheet in CONFIG_SHEETS:
+        config[sheet] = read_config_table(sheet)
+    config["label_alias_index"] = get_alias_index(config["labels_before_table"])
+    config["header_alias_index"] = get_alias_index(config["headers_table"])
+    with contextlib.suppress(OSError):
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(snapshot_path), delete=False) as f:
+            pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, snapshot_path)
+    return config
+
+
+def get_alias_index(dict_config: dict) -> dict:
+    """
+    Building the index of the config table: each alias is mapped to the unified columns it belongs to,
+    in the order of the table.
+    """
+    alias_index: dict = {}
+    for uni_column, aliases in dict_config.items():
+        for alias in aliases:
+            if uni_column not in alias_index.setdefault(alias, ()):
+                alias_index[alias] += (uni_column,)
+    return alias_index
+
+
 class MissingEnvironmentVariable(Exception):
     pass
 
 
-DICT_LABELS: dict = read_config_table("labels_before_table")
+class ArchiveLimitExceeded(Exception):
+    pass
+
+
+CONFIG: dict = load_config()
+DICT_LABELS: dict = CONFIG["labels_before_table"]
 HEADER_LABELS: list = list(DICT_LABELS)[:6]
-DICT_HEADERS_COLUMN_ENG: dict = read_config_table("headers_table")
-DICT_STATION: dict = read_config_table("station")
+LABEL_ALIAS_INDEX: dict = CONFIG["label_alias_index"]
+DICT_HEADERS_COLUMN_ENG: dict = CONFIG["headers_table"]
+HEADER_ALIAS_INDEX: dict = CONFIG["header_alias_index"]
+DICT_STATION: dict = CONFIG["station"]
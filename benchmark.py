@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import zipfile
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+from typing import Callable, Dict, List, Optional
+
+ROOT_DIRECTORY: str = os.path.dirname(os.path.abspath(__file__))
+
+COMPANY_NAMES: List[str] = [
+    'ООО "Ромашка"', 'ТОО "Лютик"', "ACME TRADING CO., LTD", "NINGBO SUNRISE IMPORT & EXPORT CO., LTD",
+    'АО "Трансконтейнер"', "ZHEJIANG GREAT WALL INDUSTRY CO., LTD", 'ИП Иванов И.И.', "OOO VOSTOK LOGISTIC"
+]
+GOODS: List[str] = [
+    "Детали для станков", "Обувь мужская", "Запасные части для автомобилей", "Ткань хлопчатобумажная",
+    "Светильники светодиодные", "Посуда керамическая", "Инструмент ручной", "Кабель силовой"
+]
+COUNTRIES: List[str] = ["CHINA/КИТАЙ", "CN", "КИТАЙ", "TURKEY/ТУРЦИЯ"]
+TABLE_COLUMNS: List[str] = [
+    "number_pp", "goods_description", "tnved_code", "country_of_origin",
+    "quantity", "package_quantity", "net_weight", "gross_weight", "total_cost"
+]
+
+# Modules that must not be loaded when main.py is imported, they are needed only for specific files
+HEAVY_MODULES: List[str] = [
+    "numpy", "pandas", "openpyxl", "xlrd", "py7zr", "rarfile", "httpx", "requests", "bs4", "deep_translator", "dadata"
+]
+IMPORT_CHECK: str = """
+import sys, json, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+loaded = [name for name in sys.argv[1:] if name in sys.modules and type(sys.modules[name]).__name__ != "_LazyModule"]
+print(json.dumps({"seconds": seconds, "loaded": loaded}))
+"""
+
+
+def check_import_time(budget: float) -> bool:
+    """
+    Import main.py in a new process and check that it fits into the budget and does not load heavy modules.
+    The first import builds the snapshot of the config, so the second one is measured.
+    :param budget: Seconds.
+    :return:
+    """
+    result: dict = {}
+    for _ in range(2):
+        output: str = subprocess.run(
+            [sys.executable, "-c", IMPORT_CHECK, *HEAVY_MODULES],
+            cwd=ROOT_DIRECTORY, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+    print(f"Импорт main.py: {result['seconds']:.3f} с (бюджет {budget:.3f} с)")
+    if result["loaded"]:
+        print(f"При импорте загружены тяжёлые модули: {', '.join(result['loaded'])}")
+    return result["seconds"] <= budget and not result["loaded"]
+
+
+class SyntheticCorpus:
+    """
+    Generates invoice workbooks from the vocabularies of unzipping_table.xlsx and wraps them in nested archives.
+    """
+    def __init__(self, directory: str, workbooks: int, rows: int, formats: List[str], seed: int):
+        self.directory: str = directory
+        self.workbooks: int = workbooks
+        self.rows: int = rows
+        self.formats: List[str] = formats
+        self.random: random.Random = random.Random(seed)
+        self.workbook_paths: List[str] = []
+
+    def get_value(self, column: str, index: int) -> str:
+        """
+        Getting the value of the cell in the table.
+        :param column:
+        :param index:
+        :return:
+        """
+        values: Dict[str, Callable[[], str]] = {
+            "number_pp": lambda: str(index),
+            "goods_description": lambda: self.random.choice(GOODS),
+            "tnved_code": lambda: str(self.random.randint(10 ** 9, 10 ** 10 - 1)),
+            "country_of_origin": lambda: self.random.choice(COUNTRIES),
+            "quantity": lambda: str(self.random.randint(1, 5000)),
+            "package_quantity": lambda: str(self.random.randint(1, 100)),
+            "net_weight": lambda: f"{self.random.uniform(1, 1000):.2f}",
+            "gross_weight": lambda: f"{self.random.uniform(1, 1000):.2f}",
+            "total_cost": lambda: f"{self.random.uniform(10, 100000):.2f}"
+        }
+        return values[column]()
+
+    def create_workbook(self, file_path: str) -> None:
+        """
+        Create the invoice workbook: the labels before the table, the header of the table and the goods.
+        :param file_path:
+        :return:
+        """
+        import openpyxl
+        from __init__ import DICT_LABELS, DICT_HEADERS_COLUMN_ENG
+
+        workbook = openpyxl.Workbook()
+        worksheet = workbook.active
+        worksheet.title = "Invoice"
+        worksheet.append(["INVOICE / ИНВОЙС"])
+        for label in ("seller", "seller_priority", "buyer", "buyer_priority", "destination_station"):
+            value: str = "Алматы-1" if label == "destination_station" else self.random.choice(COMPANY_NAMES)
+            worksheet.append([self.random.choice(DICT_LABELS[label]), None, value])
+        worksheet.append([None])
+        worksheet.append([self.random.choice(DICT_HEADERS_COLUMN_ENG[column]) for column in TABLE_COLUMNS])
+        for index in range(1, self.rows + 1):
+            worksheet.append([self.get_value(column, index) for column in TABLE_COLUMNS])
+        workbook.save(file_path)
+
+    def create_archive(self, archive_format: str, archive_path: str, file_paths: List[str]) -> bool:
+        """
+        Create the archive of the specified format.
+        :param archive_format:
+        :param archive_path:
+        :param file_paths:
+        :return: False if the archive of this format can't be created here.
+        """
+        if archive_format == "zip":
+            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                for file_path in file_paths:
+                    zip_ref.write(file_path, os.path.basename(file_path))
+        elif archive_format == "7z":
+            import py7zr
+            with py7zr.SevenZipFile(archive_path, 'w') as seven_zip_ref:
+                for file_path in file_paths:
+                    seven_zip_ref.write(file_path, os.path.basename(file_path))
+        elif archive_format == "rar":
+            if not shutil.which("rar"):
+                print("Утилита rar не найдена, архивы RAR пропущены")
+                return False
+            subprocess.run(["rar", "a", "-ep", "-inul", archive_path, *file_paths], check=True)
+        return True
+
+    def generate(self) -> str:
+        """
+        Generate the workbooks and wrap them in nested archives, the first format is the outermost one.
+        :return: Path to the outermost archive.
+        """
+        workbooks_dir: str = os.path.join(self.directory, "workbooks")
+        os.makedirs(workbooks_dir, exist_ok=True)
+        for index in range(self.workbooks):
+            file_path: str = os.path.join(workbooks_dir, f"invoice_{index}.xlsx")
+            self.create_workbook(file_path)
+            self.workbook_paths.append(file_path)
+        file_paths: List[str] = self.workbook_paths
+        for level, archive_format in enumerate(reversed(self.formats)):
+            archive_path: str = os.path.join(self.directory, f"level_{len(self.formats) - level}.{archive_format}")
+            if self.create_archive(archive_format, archive_path, file_paths):
+                file_paths = [archive_path]
+        return file_paths[0]
+
+
+class Benchmark:
+    """
+    Times ArchiveExtractor.process_archive, DataExtractor.read_excel_file and DataExtractor.parse_rows separately.
+    Company lookups and the cache of the parsed workbooks are stubbed out, so the numbers do not depend on the network.
+    """
+    def __init__(self, corpus: SyntheticCorpus, repeat: int):
+        self.corpus: SyntheticCorpus = corpus
+        self.repeat: int = repeat
+        self.results: List[dict] = []
+
+    @staticmethod
+    def get_peak_rss() -> float:
+        """
+        Getting the peak RSS of this process and of the pool workers in megabytes.
+        :return:
+        """
+        peak_rss: int = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        )
+        return peak_rss / 1024
+
+    @staticmethod
+    def count_records(directory: str) -> int:
+        """
+        Count the records written to the json directory, so that rows/s shows the rows actually parsed.
+        :param directory:
+        :return:
+        """
+        records: int = 0
+        json_dir: str = os.path.join(directory, "json")
+        for file_name in os.listdir(json_dir) if os.path.isdir(json_dir) else []:
+            if file_name.startswith("."):
+                continue
+            with open(os.path.join(json_dir, file_name), encoding="utf-8") as f:
+                if file_name.endswith(".json"):
+                    records += len(json.load(f))
+                else:
+                    records += sum("context" not in json.loads(line) for line in f)
+        return records
+
+    def measure(self, name: str, func: Callable[[], None], files: int, count_rows: Callable[[], int]) -> None:
+        """
+        Run the function several times and save the median time.
+        :param name:
+        :param func:
+        :param files:
+        :param count_rows: Returns the number of rows parsed by the last run. It is not timed.
+        :return:
+        """
+        timings: List[float] = []
+        rows: int = 0
+        for _ in range(self.repeat):
+            start: float = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+            rows = count_rows()
+        median: float = statistics.median(timings)
+        self.results.append({
+            "name": name,
+            "seconds": median,
+            "files_per_second": files / median,
+            "rows_per_second": rows / median,
+            "peak_rss_mb": self.get_peak_rss()
+        })
+
+    def run(self, archive_path: str) -> None:
+        """
+        Run all benchmarks.
+        :param archive_path:
+        :return:
+        """
+        import main
+
+        main.UnifiedContextProcessor.unify_companies = staticmethod(lambda context, token_index: None)
+        main.UnifiedContextProcessor.prefetch_companies = staticmethod(lambda companies: None)
+        main.WorkbookCache.get = classmethod(lambda cls, content_hash: None)
+        main.WorkbookCache.add = classmethod(lambda cls, content_hash, list_data: None)
+        output_dir: str = os.path.join(self.corpus.directory, "output")
+        processing_dir: str = os.path.join(self.corpus.directory, "processing")
+        list_data: List[dict] = []
+
+        dataframes: list = []
+        for file_path in self.corpus.workbook_paths:
+            df = main.pd.read_excel(file_path, dtype=str)
+            dataframes.append(df.dropna(how='all').replace({main.np.nan: None, "NaT": None}))
+
+        def parse_rows() -> None:
+            list_data.clear()
+            for index, df in enumerate(dataframes):
+                main.DataExtractor(self.corpus.workbook_paths[index], output_dir, "benchmark").parse_rows(df, list_data)
+
+        def read_excel_file() -> None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            for file_path in self.corpus.workbook_paths:
+                main.DataExtractor(file_path, output_dir, "benchmark").read_excel_file()
+
+        def process_archive() -> None:
+            shutil.rmtree(processing_dir, ignore_errors=True)
+            os.makedirs(processing_dir)
+            input_path: str = shutil.copy(archive_path, processing_dir)
+            archive_extractor: main.ArchiveExtractor = main.ArchiveExtractor(processing_dir)
+            try:
+                archive_extractor.process_input(input_path)
+            finally:
+                archive_extractor.shutdown_executor()
+
+        self.measure("parse_rows", parse_rows, self.corpus.workbooks, lambda: len(list_data))
+        self.measure(
+            "read_excel_file", read_excel_file, self.corpus.workbooks, lambda: self.count_records(output_dir)
+        )
+        self.measure(
+            "process_archive", process_archive, self.corpus.workbooks, lambda: self.count_records(processing_dir)
+        )
+
+    def print_results(self) -> None:
+        """
+        Print the results as a table.
+        :return:
+        """
+        print(f"{'benchmark':<18}{'seconds':>10}{'files/s':>12}{'rows/s':>14}{'peak RSS, MB':>15}")
+        for result in self.results:
+            print(
+                f"{result['name']:<18}{result['seconds']:>10.3f}{result['files_per_second']:>12.1f}"
+                f"{result['rows_per_second']:>14.0f}{result['peak_rss_mb']:>15.1f}"
+            )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Benchmark of the archive processing")
+    parser.add_argument("--workbooks", type=int, default=20, help="Number of workbooks in the corpus")
+    parser.add_argument("--rows", type=int, default=500, help="Number of goods in each workbook")
+    parser.add_argument("--formats", default="zip,7z", help="Nested archives from the outermost one: zip, 7z, rar")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark")
+    parser.add_argument("--workers", type=int, default=1, help="Size of the pool for parsing workbooks")
+    parser.add_argument("--reader", default="pandas", help="Reader of the workbooks: pandas or stream")
+    parser.add_argument("--import-budget", type=float, default=0.1, help="Budget for the import of main.py, seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args: argparse.Namespace = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="unzipping_benchmark_") as directory:
+        # Logs, cache.db and the config are kept in the temporary root, so that the runs are independent
+        shutil.copy(os.path.join(ROOT_DIRECTORY, "unzipping_table.xlsx"), directory)
+        os.environ["XL_IDP_ROOT_UNZIPPING"] = directory
+        os.environ["XL_IDP_WORKERS"] = str(args.workers)
+        os.environ["XL_IDP_EXCEL_READER"] = args.reader
+        sys.path.insert(0, ROOT_DIRECTORY)
+        logging.disable(logging.INFO)
+        is_import_in_budget: bool = check_import_time(args.import_budget)
+
+        corpus: SyntheticCorpus = SyntheticCorpus(
+            directory, args.workbooks, args.rows, args.formats.split(","), args.seed
+        )
+        archive_path: str = corpus.generate()
+        benchmark: Benchmark = Benchmark(corpus, args.repeat)
+        benchmark.run(archive_path)
+        benchmark.print_results()
+    if not is_import_in_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import io
+import abc
+import math
+import zipfile
+from __init__ import *
+from itertools import islice
+from datetime import time
+from typing import Any, Dict, List, Union, Callable, Iterator, Optional
+
+xlrd = lazy_import("xlrd")
+openpyxl = lazy_import("openpyxl")
+
+
+class LazyDataFrame:
+    """
+    The DataFrame of the sheet that is built on the first access to it.
+    """
+    def __init__(self, get_dataframe: Callable[[], pd.DataFrame]):
+        self.get_dataframe: Callable[[], pd.DataFrame] = get_dataframe
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get_dataframe(), name)
+
+
+class BaseWorkbookReader(abc.ABC):
+    """
+    Reads the sheets of a workbook. The last sheet read as a DataFrame is kept.
+    """
+    def __init__(self, source: Union[str, io.BytesIO]):
+        self.source: Union[str, io.BytesIO] = source
+        self.sheet_names: List[str] = []
+        self.dataframe: Tuple[Optional[str], Optional[pd.DataFrame]] = (None, None)
+
+    def __enter__(self) -> "BaseWorkbookReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @abc.abstractmethod
+    def get_first_rows(self, sheet: str, nrows: int) -> List[list]:
+        pass
+
+    @abc.abstractmethod
+    def get_dataframe(self, sheet: str) -> pd.DataFrame:
+        pass
+
+    @abc.abstractmethod
+    def get_chunks(self, sheet: str) -> Iterator[np.ndarray]:
+        pass
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        pass
+
+
+class WorkbookReader(BaseWorkbookReader):
+    """
+    Reads the sheets of a workbook through pandas. The workbook is opened once, the sheets are parsed on demand.
+    """
+    def __init__(self, source: Union[str, io.BytesIO]):
+        super().__init__(source)
+        self.excel_file: pd.ExcelFile = pd.ExcelFile(source)
+        self.sheet_names = self.excel_file.sheet_names
+
+    def get_first_rows(self, sheet: str, nrows: int) -> List[list]:
+        """
+        Getting the first rows of the sheet, including the header row.
+        :param sheet:
+        :param nrows:
+        :return:
+        """
+        df: pd.DataFrame = self.excel_file.parse(sheet_name=sheet, dtype=str, header=None, nrows=nrows)
+        return df.to_numpy(dtype=object).tolist()
+
+    def get_dataframe(self, sheet: str) -> pd.DataFrame:
+        """
+        Getting the sheet as a DataFrame without empty rows. The last parsed sheet is kept.
+        :param sheet:
+        :return:
+        """
+        if self.dataframe[0] != sheet:
+            df: pd.DataFrame = self.excel_file.parse(sheet_name=sheet, dtype=str)
+            self.dataframe = (sheet, df.dropna(how='all').replace({np.nan: None, "NaT": None}))
+        return self.dataframe[1]
+
+    def get_chunks(self, sheet: str) -> Iterator[np.ndarray]:
+        """
+        Getting the rows of the sheet after the header row as two-dimensional arrays.
+        :param sheet:
+        :return:
+        """
+        yield self.get_dataframe(sheet).to_numpy(dtype=object)
+
+    def close(self) -> None:
+        self.excel_file.close()
+
+
+class StreamWorkbookReader(BaseWorkbookReader):
+    """
+    Reads the rows of a sheet one by one and passes them on in chunks, without building a DataFrame.
+    The values are the same as in the DataFrame read by pandas.
+    """
+    def to_string(self, value: Any) -> Optional[str]:
+        """
+        Converting the value of the cell the way pd.read_excel(dtype=str) with the replacement of NaN and NaT does.
+        :param value:
+        :return:
+        """
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+        if isinstance(value, str):
+            return None if value in NA_VALUES else value
+        return str(value)
+
+    @abc.abstractmethod
+    def get_width(self, sheet: str) -> int:
+        """
+        Getting the number of columns of the sheet the way pandas counts them: up to the last non-empty cell
+        in any row, including the header row.
+        :param sheet:
+        :return:
+        """
+        pass
+
+    @abc.abstractmethod
+    def iter_sheet_rows(self, sheet: str) -> Iterator[list]:
+        """
+        Getting all rows of the sheet with the converted values.
+        :param sheet:
+        :return:
+        """
+        pass
+
+    def iter_rows(self, sheet: str) -> Iterator[list]:
+        """
+        Getting the rows of the sheet like pandas does: the first row is the header, empty rows are dropped.
+        :param sheet:
+        :return:
+        """
+        rows: Iterator[list] = self.iter_sheet_rows(sheet)
+        next(rows, None)
+        for row in rows:
+            if any(cell is not None for cell in row):
+                yield row
+
+    def get_first_rows(self, sheet: str, nrows: int) -> List[list]:
+        return list(islice(self.iter_sheet_rows(sheet), nrows))
+
+    def get_dataframe(self, sheet: str) -> pd.DataFrame:
+        """
+        Building the DataFrame of the sheet. It is only needed for the search of the taxpayer ID in the whole sheet.
+        :param sheet:
+        :return:
+        """
+        if self.dataframe[0] != sheet:
+            rows: List[list] = list(self.iter_rows(sheet))
+            width: int = max([self.get_width(sheet), *map(len, rows)])
+            self.dataframe = (sheet, pd.DataFrame(self.to_array(rows, width)))
+        return self.dataframe[1]
+
+    def get_chunks(self, sheet: str) -> Iterator[np.ndarray]:
+        """
+        Getting the rows of the sheet after the header row in chunks of ROWS_CHUNK_SIZE rows.
+        Rows are padded with None to the width of the sheet, so all chunks have the width of the DataFrame.
+        The width is known before the first chunk, for .xlsx it takes a pass over the whole sheet.
+        :param sheet:
+        :return:
+        """
+        width: int = self.get_width(sheet)
+        chunk: List[list] = []
+        for row in self.iter_rows(sheet):
+            chunk.append(row)
+            if len(chunk) == ROWS_CHUNK_SIZE:
+                yield self.to_array(chunk, width)
+                chunk = []
+        if chunk:
+            yield self.to_array(chunk, width)
+
+    @staticmethod
+    def to_array(chunk: List[list], width: int) -> np.ndarray:
+        """
+        Converting the rows to the two-dimensional array of objects.
+        :param chunk:
+        :param width:
+        :return:
+        """
+        values: np.ndarray = np.empty((len(chunk), width), dtype=object)
+        for index, row in enumerate(chunk):
+            values[index, :len(row)] = row
+        return values
+
+
+class OpenpyxlWorkbookReader(StreamWorkbookReader):
+    """
+    Streams the rows of .xlsx workbooks with openpyxl in the read-only mode.
+    """
+    def __init__(self, source: Union[str, io.BytesIO]):
+        super().__init__(source)
+        self.workbook: openpyxl.Workbook = openpyxl.load_workbook(
+            source, read_only=True, data_only=True, keep_links=False
+        )
+        self.sheet_names = [worksheet.title for worksheet in self.workbook.worksheets]
+        self.widths: Dict[str, int] = {}
+
+    def get_width(self, sheet: str) -> int:
+        """
+        Getting the width of the sheet by a pass over its values. The dimension declared in the workbook
+        is not used: it also covers the formatted empty cells, which pandas drops. So the first chunk
+        of the sheet is ready only after this pass, the stream reader saves memory, not time to the first row.
+        :param sheet:
+        :return:
+        """
+        if sheet not in self.widths:
+            worksheet = self.workbook[sheet]
+            worksheet.reset_dimensions()
+            self.widths[sheet] = max(
+                (
+                    next((len(row) - index for index, value in enumerate(reversed(row)) if value not in (None, "")), 0)
+                    for row in worksheet.iter_rows(values_only=True)
+                ),
+                default=0
+            )
+        return self.widths[sheet]
+
+    def convert_cell(self, cell) -> Optional[str]:
+        """
+        Converting the cell the way pandas does: whole numbers become integers, errors become empty values.
+        :param cell:
+        :return:
+        """
+        if cell.value is None or cell.data_type == openpyxl.cell.cell.TYPE_ERROR:
+            return None
+        if cell.data_type == openpyxl.cell.cell.TYPE_NUMERIC:
+            return self.to_string(int(cell.value) if int(cell.value) == cell.value else float(cell.value))
+        return self.to_string(cell.value)
+
+    def iter_sheet_rows(self, sheet: str) -> Iterator[list]:
+        worksheet = self.workbook[sheet]
+        worksheet.reset_dimensions()
+        for row in worksheet.rows:
+            converted_row: list = [self.convert_cell(cell) for cell in row]
+            while converted_row and converted_row[-1] is None:
+                converted_row.pop()
+            yield converted_row
+
+    def close(self) -> None:
+        self.workbook.close()
+
+
+class XlrdWorkbookReader(StreamWorkbookReader):
+    """
+    Streams the rows of .xls workbooks with xlrd. The sheets are loaded on demand.
+    """
+    def __init__(self, source: Union[str, io.BytesIO]):
+        super().__init__(source)
+        if isinstance(source, str):
+            self.workbook: xlrd.Book = xlrd.open_workbook(source, on_demand=True)
+        else:
+            self.workbook: xlrd.Book = xlrd.open_workbook(file_contents=source.read(), on_demand=True)
+        self.sheet_names = self.workbook.sheet_names()
+
+    def get_width(self, sheet: str) -> int:
+        return self.workbook.sheet_by_name(sheet).ncols
+
+    def convert_cell(self, value: Any, cell_type: int) -> Optional[str]:
+        """
+        Converting the cell the way pandas does: dates become datetime or time, whole numbers become integers.
+        :param value:
+        :param cell_type:
+        :return:
+        """
+        if cell_type == xlrd.XL_CELL_DATE:
+            try:
+                value = xlrd.xldate.xldate_as_datetime(value, self.workbook.datemode)
+            except OverflowError:
+                return self.to_string(value)
+            if value.timetuple()[:3] == ((1904, 1, 1) if self.workbook.datemode else (1899, 12, 31)):
+                value = time(value.hour, value.minute, value.second, value.microsecond)
+        elif cell_type == xlrd.XL_CELL_ERROR:
+            return None
+        elif cell_type == xlrd.XL_CELL_BOOLEAN:
+            value = bool(value)
+        elif cell_type == xlrd.XL_CELL_NUMBER and math.isfinite(value) and int(value) == value:
+            value = int(value)
+        return self.to_string(value)
+
+    def iter_sheet_rows(self, sheet: str) -> Iterator[list]:
+        worksheet = self.workbook.sheet_by_name(sheet)
+        for index in range(worksheet.nrows):
+            yield [
+                self.convert_cell(value, cell_type)
+                for value, cell_type in zip(worksheet.row_values(index), worksheet.row_types(index))
+            ]
+
+    def close(self) -> None:
+        self.workbook.release_resources()
+
+
+def get_workbook_reader(source: Union[str, io.BytesIO], reader_name: str = EXCEL_READER) -> BaseWorkbookReader:
+    """
+    Getting the reader of the workbook set by XL_IDP_EXCEL_READER: pandas or stream.
+    :param source: Path to the workbook or its content.
+    :param reader_name: The reader to use instead of the configured one.
+    :return:
+    """
+    if reader_name != "stream":
+        return WorkbookReader(source)
+    is_xlsx: bool = zipfile.is_zipfile(source)
+    if not isinstance(source, str):
+        source.seek(0)
+    return OpenpyxlWorkbookReader(source) if is_xlsx else XlrdWorkbookReader(source)
@@ -0,0 +1,179 @@
+import os
+import time
+import contextlib
+from __init__ import *
+from typing import Dict, List, Iterable, Iterator, Optional
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class FileSettleTracker:
+    """
+    Tracks the size and modification time of the files in the upload directory at the same time.
+    A file is considered fully loaded when neither its size nor its mtime changed during the settle window.
+    A file closed by its writer only has to stay unchanged for the short confirmation window.
+    """
+    def __init__(
+        self,
+        settle_time: float = WAITING_TIME,
+        poll_interval: float = POLL_INTERVAL,
+        closed_settle_time: float = CLOSED_WAITING_TIME
+    ):
+        self.settle_time: float = settle_time
+        self.poll_interval: float = poll_interval
+        self.closed_settle_time: float = closed_settle_time
+        self.snapshots: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        self.closed: set = set()
+
+    @staticmethod
+    def get_signature(file_path: str) -> Optional[Tuple[int, int]]:
+        """
+        Getting the size and the last modification time of a file.
+        For a directory, the total size and the latest mtime of all nested files are used.
+        :param file_path:
+        :return:
+        """
+        try:
+            stat: os.stat_result = os.stat(file_path)
+            if not os.path.isdir(file_path):
+                return stat.st_size, stat.st_mtime_ns
+            total_size, last_mtime = 0, stat.st_mtime_ns
+            for root, dirs, files in os.walk(file_path):
+                for name in dirs + files:
+                    item_stat: os.stat_result = os.stat(os.path.join(root, name))
+                    total_size += item_stat.st_size
+                    last_mtime = max(last_mtime, item_stat.st_mtime_ns)
+            return total_size, last_mtime
+        except FileNotFoundError:
+            return None
+
+    def add(self, file_path: str, is_closed: bool = False) -> None:
+        """
+        Start tracking the file, if it is not tracked yet.
+        :param file_path:
+        :param is_closed: Whether the writer has closed the file (or moved it into the directory) just now.
+        The confirmation window of such a file starts now.
+        :return:
+        """
+        if is_closed and (signature := self.get_signature(file_path)):
+            self.snapshots[file_path] = (signature, time.monotonic())
+            self.closed.add(file_path)
+            return
+        self.closed.discard(file_path)
+        if file_path not in self.snapshots and (signature := self.get_signature(file_path)):
+            self.snapshots[file_path] = (signature, time.monotonic())
+
+    def get_timeout(self) -> Optional[float]:
+        """
+        Getting the time to wait for new events before the next poll.
+        :return: None, if no file is tracked.
+        """
+        if not self.snapshots:
+            return None
+        return min(self.poll_interval, self.closed_settle_time) if self.closed else self.poll_interval
+
+    def poll(self) -> List[str]:
+        """
+        Checking all tracked files once.
+        :return: Files that have been stable for the settle window. They are no longer tracked.
+        """
+        settled: List[str] = []
+        now: float = time.monotonic()
+        for file_path, (signature, stable_since) in list(self.snapshots.items()):
+            current_signature: Optional[Tuple[int, int]] = self.get_signature(file_path)
+            if current_signature is None:
+                del self.snapshots[file_path]
+                self.closed.discard(file_path)
+            elif current_signature != signature:
+                self.snapshots[file_path] = (current_signature, now)
+                self.closed.discard(file_path)
+            elif now - stable_since >= (self.closed_settle_time if file_path in self.closed else self.settle_time):
+                del self.snapshots[file_path]
+                self.closed.discard(file_path)
+                settled.append(file_path)
+        return settled
+
+    def wait_for_settled(self, file_paths: Iterable[str]) -> Iterator[str]:
+        """
+        Yields each file as soon as it is fully loaded.
+        :param file_paths:
+        :return:
+        """
+        for file_path in file_paths:
+            self.add(file_path)
+        while self.snapshots:
+            yield from self.poll()
+            if self.snapshots:
+                time.sleep(min(self.poll_interval, self.settle_time))
+
+
+class ScanEventSource:
+    """
+    Fallback source of new files: lists the upload directory on every read.
+    It also works on network shares, where inotify does not see changes made by other hosts.
+    """
+    def __init__(self, directory: str):
+        self.directory: str = directory
+
+    def get_candidates(self) -> List[str]:
+        """
+        Getting the files and directories uploaded to the directory.
+        :return:
+        """
+        with os.scandir(self.directory) as entries:
+            return [entry.path for entry in entries if entry.name not in BASE_DIRECTORIES]
+
+    def read(self, timeout: Optional[float]) -> Dict[str, bool]:
+        """
+        Waiting for the timeout and listing the directory.
+        :param timeout: Seconds to wait. None means the default poll interval.
+        :return: Files mapped to whether their writer has closed them. Listing can not tell it, so it is always False.
+        """
+        time.sleep(POLL_INTERVAL if timeout is None else timeout)
+        return dict.fromkeys(self.get_candidates(), False)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyEventSource(ScanEventSource):
+    """
+    Source of new files based on inotify notifications about the upload directory.
+    """
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.inotify: INotify = INotify()
+        self.inotify.add_watch(directory, flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MODIFY)
+
+    def read(self, timeout: Optional[float]) -> Dict[str, bool]:
+        """
+        Waiting for notifications about the directory.
+        :param timeout: Seconds to wait. None means to wait until something happens.
+        :return: Files mapped to whether the last event about them is CLOSE_WRITE or MOVED_TO.
+        """
+        events: list = self.inotify.read(timeout=None if timeout is None else int(timeout * 1000))
+        closed: Dict[str, bool] = {}
+        for event in events:
+            if event.name and event.name not in BASE_DIRECTORIES:
+                closed[os.path.join(self.directory, event.name)] = bool(
+                    event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO)
+                )
+        return closed
+
+    def close(self) -> None:
+        self.inotify.close()
+
+
+def get_event_source(directory: str) -> ScanEventSource:
+    """
+    Getting the source of new files. Inotify is used when it is available, otherwise the directory is scanned.
+    :param directory:
+    :return:
+    """
+    if WATCH_MODE == "inotify" and INotify is not None:
+        with contextlib.suppress(OSError):
+            return InotifyEventSource(directory)
+    return ScanEventSource(directory)
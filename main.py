@@ -1,11 +1,34 @@
+from __future__ import annotations
+
+import io
 import json
-import py7zr
+import hashlib
+import argparse
 import shutil
 import zipfile
-import rarfile
+import itertools
+import multiprocessing
 from pprint import pprint
+from functools import lru_cache
+from datetime import datetime, timedelta
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from file_watcher import *
+from excel_reader import *
+from output_sink import *
 from unified_companies import *
-from typing import Dict, List, Optional, Callable
+from typing import IO, Dict, List, Union, Iterable, Optional, Callable
+
+py7zr = lazy_import("py7zr")
+rarfile = lazy_import("rarfile")
+
+OUTPUT_LOCK: multiprocessing.Lock = multiprocessing.Lock()
+
+RE_SPACES: re.Pattern = re.compile(r"\s+", flags=re.UNICODE)
+RE_CHINESE: re.Pattern = re.compile(r'[\u4e00-\u9fff]+')
+RE_SPACE_BETWEEN_DIGITS: re.Pattern = re.compile(r'(?<=\d) (?=\d)')
+RE_LABEL_SPLITTER: re.Pattern = re.compile(r'[:：]')
+COLONS_TABLE: dict = {ord(c): "" for c in ":："}
 
 
 class JsonEncoder(json.JSONEncoder):
@@ -15,9 +38,114 @@ class JsonEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class WorkbookCache:
+    """
+    Persistent index of the parsed workbooks in cache.db: the content hash of a workbook is mapped to its records.
+    The records expire after WORKBOOK_CACHE_TTL, since the companies unified in them may change in the registries.
+    """
+    table_name: str = "workbook_cache"
+
+    @classmethod
+    def create_table(cls) -> None:
+        """
+        Creating the table of the cache in the connection of the process.
+        :return:
+        """
+        CacheConnection.create_table(cls.table_name, "content_hash TEXT PRIMARY KEY, records TEXT, parsed_on TEXT")
+
+    @classmethod
+    def get(cls, content_hash: str) -> Optional[List[dict]]:
+        """
+        Getting the records of the workbook parsed earlier.
+        :param content_hash:
+        :return:
+        """
+        cls.create_table()
+        row: Optional[tuple] = CacheConnection.fetch_one(
+            f'SELECT records, parsed_on FROM "{cls.table_name}" WHERE content_hash=?', (content_hash,)
+        )
+        if not row or datetime.fromisoformat(row[1]) + timedelta(seconds=WORKBOOK_CACHE_TTL) <= datetime.now():
+            return None
+        records: Union[List[dict], Dict[str, list]] = json.loads(row[0])
+        return expand_document(records) if isinstance(records, dict) else records
+
+    @classmethod
+    def add(cls, content_hash: str, list_data: RecordSink) -> None:
+        """
+        Saving the records of the parsed workbook in the compact form. Workbooks with too many records are not saved.
+        :param content_hash:
+        :param list_data:
+        :return:
+        """
+        if (document := list_data.get_document()) is None:
+            return
+        cls.create_table()
+        records: str = json.dumps(document, ensure_ascii=False, cls=JsonEncoder)
+        CacheConnection.execute(
+            f"INSERT or REPLACE INTO {cls.table_name} VALUES(?, ?, ?)", (content_hash, records, str(datetime.now()))
+        )
+
+
+class ProcessingJournal:
+    """
+    Durable journal of the processing in cache.db: (input, member, stage, status).
+    It allows to skip the members already parsed, when the input is processed again after a crash or a restart.
+    """
+    table_name: str = "processing_journal"
+
+    def __init__(self):
+        CacheConnection.create_table(
+            self.table_name,
+            "input TEXT, member TEXT, stage TEXT, status TEXT, updated_on TEXT, PRIMARY KEY (input, member)"
+        )
+
+    def get_status(self, input_id: str, member: str) -> Optional[str]:
+        """
+        Getting the status of the member of the input.
+        :param input_id:
+        :param member:
+        :return:
+        """
+        row: Optional[tuple] = CacheConnection.fetch_one(
+            f'SELECT status FROM "{self.table_name}" WHERE input=? AND member=?', (input_id, member)
+        )
+        return row[0] if row else None
+
+    def set_status(self, input_id: str, member: str, stage: str, status: str) -> None:
+        """
+        Saving the status of the member of the input.
+        :param input_id:
+        :param member:
+        :param stage:
+        :param status:
+        :return:
+        """
+        CacheConnection.execute(
+            f"INSERT or REPLACE INTO {self.table_name} VALUES(?, ?, ?, ?, ?)",
+            (input_id, member, stage, status, str(datetime.now()))
+        )
+
+    def remove(self, input_id: str) -> None:
+        """
+        Removing the records of the input, which has been processed completely.
+        :param input_id:
+        :return:
+        """
+        CacheConnection.execute(f'DELETE FROM "{self.table_name}" WHERE input=?', (input_id,))
+
+
 class DataExtractor:
-    def __init__(self, filename: str, directory: str, input_data: str):
+    def __init__(
+        self,
+        filename: str,
+        directory: str,
+        input_data: str,
+        content: Optional[bytes] = None,
+        batch: Optional[OutputBatch] = None
+    ):
         self.filename: str = filename
+        self.content: Optional[bytes] = content
+        self.batch: Optional[OutputBatch] = batch
         self.directory: str = directory
         self.input_data: str = input_data
         self.dict_columns_position: Dict[str, Optional[int]] = {
@@ -33,9 +161,12 @@ class DataExtractor:
             "price_per_piece": None,
             "total_cost": None
         }
+        self.is_parsed_with_errors: bool = False
+        self.is_lookup_failed: bool = False
         self.logger: logging.getLogger = get_logger(f"data_extractor {str(datetime.now().date())}")
 
     @staticmethod
+    @lru_cache(maxsize=NORMALIZED_CELLS_CACHE_SIZE)
     def _is_digit(x: str) -> bool:
         """
         Checks if a value is a number.
@@ -43,7 +174,7 @@ class DataExtractor:
         if x is None:
             return False
         try:
-            float(re.sub(r'(?<=\d) (?=\d)', '', x))
+            float(RE_SPACE_BETWEEN_DIGITS.sub('', x))
             return True
         except (ValueError, TypeError):
             return False
@@ -71,45 +202,105 @@ class DataExtractor:
         ) and row[self.dict_columns_position["tnved_code"]] \
             and any(char.isdigit() for char in row[self.dict_columns_position["tnved_code"]])
 
-    def _remove_spaces_and_symbols(self, row: str) -> str:
+    def _is_table_starting_at(self, row: list, is_table_starting: Optional[bool]) -> bool:
+        """
+        Understanding when a headerless table starts, using the value precomputed for the whole sheet, if there is one.
+        """
+        return self._is_table_starting(row) if is_table_starting is None else is_table_starting
+
+    @staticmethod
+    @lru_cache(maxsize=NORMALIZED_CELLS_CACHE_SIZE)
+    def _remove_spaces_and_symbols(row: str) -> str:
         """
         Remove spaces.
         """
-        row: str = row.translate({ord(c): "" for c in ":："}).strip()
-        return self._remove_many_spaces(row)
+        row: str = row.translate(COLONS_TABLE).strip()
+        return DataExtractor._remove_many_spaces(row)
 
     @staticmethod
+    @lru_cache(maxsize=NORMALIZED_CELLS_CACHE_SIZE)
     def _remove_many_spaces(row: str, is_remove_spaces: bool = True) -> str:
         """
         Bringing the header column to a unified form.
+        The same values are repeated in every sheet and file, so the results are cached.
         """
         if is_remove_spaces:
-            return re.sub(r"\s+", "", row, flags=re.UNICODE).upper() if row else row
-        row: str = re.sub(r'[\u4e00-\u9fff]+', "", row) if row else row
-        row: str = re.sub(r"\n", " ", row).strip() if row else row
-        return re.sub(r"\s+", " ", row).strip() if row else row
+            return RE_SPACES.sub("", row).upper() if row else row
+        row: str = RE_CHINESE.sub("", row) if row else row
+        row: str = row.replace("\n", " ").strip() if row else row
+        return RE_SPACES.sub(" ", row).strip() if row else row
 
     @staticmethod
-    def _get_list_columns() -> List[str]:
+    @lru_cache(maxsize=NORMALIZED_CELLS_CACHE_SIZE)
+    def _split_label(row: str) -> Tuple[str, str]:
         """
-        Getting all column names for all lines in the __init__.py file.
+        Splitting the cell into the label and the value by the colon.
+        :param row:
+        :return: The label in a unified form and the value after the colon.
         """
-        list_columns: list = []
-        for keys in list(DICT_HEADERS_COLUMN_ENG.values()):
-            list_columns.extend(iter(keys))
-        return list_columns
+        splitter_column: list = RE_LABEL_SPLITTER.split(row)
+        value: str = " ".join(splitter_column[1:]).strip() or splitter_column[-1].strip()
+        return DataExtractor._remove_spaces_and_symbols(splitter_column[0]), value
 
-    def _get_probability_of_header(self, row: list, list_columns: list) -> Tuple[int, int]:
+    def _get_probability_of_header(self, row: list) -> Tuple[int, int]:
         """
         Getting the probability of a row as a header.
         """
         row: list = list(filter(lambda x: x is not None, map(self._remove_many_spaces, row)))
-        count: int = sum(element in list_columns for element in row)
+        count: int = sum(element in HEADER_ALIAS_INDEX for element in row)
         probability_of_header: int = int(count / len(row) * 100)
         if probability_of_header != 0 and probability_of_header < COEFFICIENT_OF_HEADER_PROBABILITY:
             self.logger.error(f"Probability of header is {probability_of_header}. Columns is {row}")
         return len(row), probability_of_header
 
+    def _get_probabilities_of_header(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Getting the probability of being a header for all rows at once.
+        Each distinct cell value is normalized only once.
+        :param values: Cells of the sheet.
+        :return: The number of non-empty cells and the probability of a header for each row.
+        """
+        is_filled: np.ndarray = ~pd.isnull(values)
+        unique_values: np.ndarray = pd.unique(values[is_filled])
+        is_column: dict = {value: self._remove_many_spaces(value) in HEADER_ALIAS_INDEX for value in unique_values}
+        is_header_cell: np.ndarray = np.zeros(values.shape, dtype=bool)
+        is_header_cell[is_filled] = [is_column[value] for value in values[is_filled]]
+        lengths: np.ndarray = is_filled.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probabilities: np.ndarray = np.nan_to_num(is_header_cell.sum(axis=1) / lengths * 100).astype(int)
+        return lengths, probabilities
+
+    def _get_table_starting_mask(self, values: np.ndarray) -> np.ndarray:
+        """
+        Understanding which rows start or continue a headerless table, for all rows at once.
+        :param values: Cells of the sheet.
+        :return: True or False for each row, None where the row must be checked by _is_table_starting.
+        """
+        mask: np.ndarray = np.full(len(values), None, dtype=object)
+        number_pp_index: Optional[int] = self.dict_columns_position.get("number_pp")
+        tnved_code_index: Optional[int] = self.dict_columns_position["tnved_code"]
+        if any(index is not None and index >= values.shape[1] for index in (number_pp_index, tnved_code_index)):
+            return mask
+        if (
+            self.dict_columns_position["model"] or
+            self.dict_columns_position["country_of_origin"] or
+            self.dict_columns_position["goods_description"]
+        ):
+            is_starting: np.ndarray = np.ones(len(values), dtype=bool)
+        elif number_pp_index is not None:
+            is_starting = np.array([self._is_digit(value) for value in values[:, number_pp_index]], dtype=bool)
+        else:
+            is_starting = np.zeros(len(values), dtype=bool)
+        if tnved_code_index is None:
+            mask[~is_starting] = False
+            return mask
+        has_digits: np.ndarray = np.array(
+            [bool(value) and any(char.isdigit() for char in value) for value in values[:, tnved_code_index]],
+            dtype=bool
+        )
+        mask[:] = is_starting & has_digits
+        return mask
+
     def get_unique_filename(self, target_dir: str, base_name: str) -> str:
         """
         Checks the existence of the file and adds a suffix (_1, _2, etc.) if the file with the same name exists
@@ -123,7 +314,7 @@ class DataExtractor:
         # Check if the file exists and if the size is the same
         if os.path.exists(dest_path):
             original_size: int = os.path.getsize(dest_path)
-            current_size: int = os.path.getsize(self.filename)
+            current_size: int = os.path.getsize(self.filename) if self.content is None else len(self.content)
 
             if original_size == current_size:
                 return dest_path  # Overwrite if the size is the same
@@ -147,39 +338,104 @@ class DataExtractor:
         os.makedirs(target_dir, exist_ok=True)
 
         base_name: str = os.path.basename(self.filename)
-        unique_path: str = self.get_unique_filename(target_dir, base_name)
-
-        shutil.copy(self.filename, unique_path)
+        with OUTPUT_LOCK:
+            unique_path: str = self.get_unique_filename(target_dir, base_name)
+            if self.content is None:
+                shutil.copy(self.filename, unique_path)
+            else:
+                with open(unique_path, 'wb') as f:
+                    f.write(self.content)
         self.logger.info(f"Файл скопирован в {unique_path}")
 
-    def write_to_file(self, list_data: list) -> None:
+    def get_source(self) -> Union[str, io.BytesIO]:
+        """
+        Getting the source of the workbook for pandas: the file itself or its content taken from the archive.
+        :return:
+        """
+        return self.filename if self.content is None else io.BytesIO(self.content)
+
+    def get_content_hash(self) -> str:
+        """
+        Getting the hash of the workbook content.
+        :return:
+        """
+        if self.content is not None:
+            return hashlib.sha256(self.content).hexdigest()
+        sha256 = hashlib.sha256()
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(pow(1024, 2)), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def get_cache_key(self) -> str:
+        """
+        Getting the key of the workbook in the cache: the hash of the content, the version of unzipping_table.xlsx
+        and the container number taken from the file name. The container number of the file name takes part
+        in parsing (the labels of the sheet may override it or not), so it can not be replaced in the cached
+        records afterwards.
+        :return:
+        """
+        mtime_ns, size = CONFIG["key"]
+        cache_key: str = f"{self.get_content_hash()}:{mtime_ns}-{size}"
+        container_number: Optional[str] = self.add_basic_columns().get(HEADER_LABELS[5])
+        return cache_key if container_number is None else f"{cache_key}:{container_number}"
+
+    def refresh_basic_columns(self, list_data: List[dict]) -> List[dict]:
+        """
+        Replacing the basic columns of the records taken from the cache with the values of the current file.
+        The container number of the file name is the same, since it is a part of the cache key.
+        :param list_data:
+        :return:
+        """
+        basic_columns: dict = self.add_basic_columns()
+        file_columns: dict = {
+            key: basic_columns[key] for key in ("original_file_name", "original_file_parsed_on", "input_data")
+        }
+        return [{**basic_columns, **parsed_record, **file_columns} for parsed_record in list_data]
+
+    def create_sink(self) -> RecordSink:
+        """
+        Creating the sink that writes the records to the json directory as they are parsed.
+        The records of a batch are written to the local temporary directory until they are appended to it.
+        :return:
+        """
+        if self.batch is not None:
+            return get_record_sink(None, JsonEncoder, is_batched=True)
+        return get_record_sink(os.path.join(self.directory, 'json'), JsonEncoder)
+
+    def write_to_file(self, list_data: RecordSink) -> None:
         """
         Write data to xlsx.
         :return:
         """
         if not list_data:
+            list_data.discard()
             self.logger.error(f"В файле не найдены данные для обработки. Файл - {self.filename}")
             self.copy_file_to_dir("errors_excel")
         else:
             self.write_to_json(list_data)
             self.copy_file_to_dir("done_excel")
 
-    def write_to_json(self, list_data: list) -> None:
+    def write_to_json(self, list_data: RecordSink) -> None:
         """
-        Write data to json.
+        Write data to json. The records are already in the temporary file, it gets the name of the workbook.
         :param list_data:
         :return:
         """
+        if self.batch is not None:
+            with OUTPUT_LOCK:
+                self.batch.append(list_data)
+            self.logger.info(f"Данные добавлены в пакет {self.batch.path}. Файл - {self.filename}")
+            return
         self.logger.info(f"Данные записываются в файл json. Файл - {self.filename}")
 
         dir_name: str = os.path.join(self.directory, 'json')
         os.makedirs(dir_name, exist_ok=True)
 
-        base_name: str = f"{os.path.basename(self.filename)}.json"
-        output_file_path: str = self.get_unique_filename(dir_name, base_name)
-
-        with open(output_file_path, 'w', encoding='utf-8') as f:
-            json.dump(list_data, f, ensure_ascii=False, indent=4, cls=JsonEncoder)
+        base_name: str = f"{os.path.basename(self.filename)}{list_data.extension}"
+        with OUTPUT_LOCK:
+            output_file_path: str = self.get_unique_filename(dir_name, base_name)
+            list_data.finalize(output_file_path)
 
         self.logger.info(f"Файл сохранён как {output_file_path}")
 
@@ -189,10 +445,8 @@ class DataExtractor:
         """
         rows: list = list(map(self._remove_many_spaces, rows))
         for index, column in enumerate(rows):
-            for uni_columns, columns in DICT_HEADERS_COLUMN_ENG.items():
-                for column_eng in columns:
-                    if column == column_eng:
-                        self.dict_columns_position[uni_columns] = index
+            for uni_columns in HEADER_ALIAS_INDEX.get(column, ()):
+                self.dict_columns_position[uni_columns] = index
         self.logger.info(f"Columns position is {self.dict_columns_position}")
 
     def is_all_right_columns(self, context: dict) -> bool:
@@ -207,46 +461,48 @@ class DataExtractor:
         self.logger.error(f"В файле нету нужных полей. Файл - {self.filename}")
         return False
 
-    def _get_address_same_keys(self, context: dict, i: int, count_address: int, row: str, rows: list) -> int:
+    @staticmethod
+    def _get_next_cells(rows: list) -> Tuple[list, list]:
+        """
+        Getting the cells after each position of the row in one pass from the end of the row.
+        :param rows:
+        :return: The first non-blank cell and the last non-empty cell starting from each position.
+        """
+        first_non_blank: list = [None] * (len(rows) + 1)
+        last_non_empty: list = [None] * (len(rows) + 1)
+        for index in range(len(rows) - 1, -1, -1):
+            cell: Optional[str] = rows[index]
+            first_non_blank[index] = cell if cell and cell.strip() else first_non_blank[index + 1]
+            last_non_empty[index] = last_non_empty[index + 1] or cell or None
+        return first_non_blank, last_non_empty
+
+    def _get_address_same_keys(self, context: dict, count_address: int, row: str, last_cell: Optional[str]) -> int:
         """
         Getting an address with the same keys.
         :param context:
-        :param i:
         :param count_address:
-        :param row:
-        :param rows:
+        :param row: One of DESTINATION_STATION_LABELS.
+        :param last_cell: The last non-empty cell after the label.
         :return:
         """
-        if row.strip() in DESTINATION_STATION_LABELS and not context.get(row):
+        if not context.get(row):
             count_address += 1
-            if count_address == 2:
-                for cell in rows[i:]:
-                    if not cell:
-                        continue
-                    cell: str = self._remove_many_spaces(cell, is_remove_spaces=False)
-                    context["destination_station"] = context[row] if context.get(row) else cell
+            if count_address == 2 and last_cell:
+                context["destination_station"] = self._remove_many_spaces(last_cell, is_remove_spaces=False)
         return count_address
 
-    def merge_sells(self, count_address: int, context: dict, i: int, row: str, rows: list) -> None:
+    def merge_sells(self, count_address: int, context: dict, next_cell: Optional[str]) -> None:
         """
         Merging sells.
         :param count_address:
         :param context:
-        :param i:
-        :param row:
-        :param rows:
+        :param next_cell: The first non-blank cell after the label of the address.
         :return:
         """
-        if row.strip() in DESTINATION_STATION_LABELS:
-            columns: list = list(DICT_LABELS.keys())
-            col_map: dict = {1: 0, 3: 1, 4: 3}  # Сопоставление count_address с индексом колонки
-
-            for cell in rows[i:]:
-                if cell and cell.strip():
-                    cell: str = self._remove_many_spaces(cell, is_remove_spaces=False)
-                    if count_address in col_map and context.get(columns[col_map[count_address]]):
-                        context[columns[col_map[count_address]]] += f" {cell}"
-                    break
+        col_map: dict = {1: 0, 3: 1, 4: 3}  # Сопоставление count_address с индексом колонки
+        if next_cell and count_address in col_map and context.get(HEADER_LABELS[col_map[count_address]]):
+            cell: str = self._remove_many_spaces(next_cell, is_remove_spaces=False)
+            context[HEADER_LABELS[col_map[count_address]]] += f" {cell}"
 
     def _get_content_before_table(self, rows: list, context: dict, count_address: int) -> int:
         """
@@ -257,6 +513,7 @@ class DataExtractor:
         :return:
         """
         range_index: dict = {}
+        next_cells: Optional[Tuple[list, list]] = None
 
         for i, row in enumerate(rows, start=1):
             if i == len(rows) and range_index:
@@ -264,13 +521,34 @@ class DataExtractor:
             if not row:
                 continue
 
-            count_address: int = self._get_address_same_keys(context, i, count_address, row, rows)
-            self.merge_sells(count_address, context, i, row, rows)
+            if row.strip() in DESTINATION_STATION_LABELS:
+                next_cells = next_cells or self._get_next_cells(rows)
+                count_address: int = self._get_address_same_keys(context, count_address, row, next_cells[1][i])
+                self.merge_sells(count_address, context, next_cells[0][i])
             self._process_row(row, i, context, range_index)
 
         self._extract_values_from_range(rows, range_index, context)
         return count_address
 
+    @staticmethod
+    @lru_cache(maxsize=NORMALIZED_CELLS_CACHE_SIZE)
+    def _match_label(row: str) -> Tuple[Tuple[str, bool], ...]:
+        """
+        Finding the labels before the table in the cell with one lookup of the whole cell and one of its part
+        before the colon.
+        :param row:
+        :return: Unified columns in the order of the table and whether the whole cell is the label.
+        """
+        whole_cell_columns: tuple = LABEL_ALIAS_INDEX.get(DataExtractor._remove_spaces_and_symbols(row), ())
+        prefix_columns: tuple = LABEL_ALIAS_INDEX.get(DataExtractor._split_label(row)[0], ())
+        if not prefix_columns:
+            return tuple((uni_columns, True) for uni_columns in whole_cell_columns)
+        return tuple(
+            (uni_columns, uni_columns in whole_cell_columns)
+            for uni_columns in DICT_LABELS
+            if uni_columns in whole_cell_columns or uni_columns in prefix_columns
+        )
+
     def _process_row(self, row: str, index: int, context: dict, range_index: dict) -> None:
         """
         Processes a row and updates context and range_index accordingly.
@@ -280,16 +558,13 @@ class DataExtractor:
         :param range_index:
         :return:
         """
-        splitter_column: list = re.split(r'[:：]', row)
-        key_cleaned: str = self._remove_spaces_and_symbols(row)
-
-        for uni_columns, columns in DICT_LABELS.items():
-            if key_cleaned in columns:
+        for uni_columns, is_whole_cell in self._match_label(row):
+            if is_whole_cell:
                 if range_index:
                     range_index[next(reversed(range_index))].append(index)
                 range_index.setdefault(uni_columns, []).append(index)
-            elif self._remove_spaces_and_symbols(splitter_column[0]) in columns:
-                context[uni_columns] = " ".join(splitter_column[1:]).strip() or splitter_column[-1].strip()
+            else:
+                context[uni_columns] = self._split_label(row)[1]
 
     def _extract_values_from_range(self, rows: list, range_index: dict, context: dict) -> None:
         """
@@ -309,7 +584,7 @@ class DataExtractor:
 
             context.setdefault(key, self._remove_many_spaces(cell, is_remove_spaces=False))
 
-    def _get_content_in_table(self, rows: list, list_data: List[dict], context: dict) -> None:
+    def _get_content_in_table(self, rows: list, list_data: RecordSink, context: dict) -> None:
         """
         Getting the data from the table.
         :param rows:
@@ -337,63 +612,227 @@ class DataExtractor:
             context[HEADER_LABELS[5]] = container_number[0]
         return context
 
-    def parse_rows(self, df: pd.DataFrame, list_data: List[dict]) -> Optional[List[dict]]:
+    def parse_rows(self, df: pd.DataFrame, list_data: RecordSink) -> Optional[RecordSink]:
         """
         Parse rows.
         :param df:
         :param list_data:
         :return:
         """
+        return self.parse_chunks([df.to_numpy(dtype=object)], df, list_data)
+
+    def parse_chunks(
+        self,
+        chunks: Iterable[np.ndarray],
+        df: Union[pd.DataFrame, LazyDataFrame],
+        list_data: RecordSink
+    ) -> Optional[RecordSink]:
+        """
+        Parse the rows of the sheet that come in chunks.
+        :param chunks: Consecutive rows of the sheet as two-dimensional arrays.
+        :param df: The whole sheet. It is needed only to search for the taxpayer IDs of the companies.
+        :param list_data:
+        :return:
+        """
         context: dict = self.add_basic_columns()
         count_address: int = 0
-        for _, rows in df.iterrows():
-            rows = list(rows.to_dict().values())
-            try:
-                len_rows, coefficient = self._get_probability_of_header(rows, self._get_list_columns())
-                if coefficient >= COEFFICIENT_OF_HEADER_PROBABILITY and len_rows >= LEN_COLUMNS_IN_ROW:
-                    if not self.is_all_right_columns(context):
-                        return
-                    UnifiedContextProcessor.unified_values(context, df)
-                    self._get_columns_position(rows)
-                elif self._is_table_starting(rows):
-                    self._get_content_in_table(rows, list_data, context)
-                else:
-                    count_address = self._get_content_before_table(rows, context, count_address)
-            except Exception as ex:
-                self.logger.error(
-                    f"Ошибка при обработке файла {self.filename}: {ex}. Предположительно нету ключа tnved_code"
-                )
-                self.copy_file_to_dir("errors_excel")
-                break
+        token_index: WorkbookTokenIndex = WorkbookTokenIndex(df)
+        for values in chunks:
+            lengths, probabilities = self._get_probabilities_of_header(values)
+            table_starting_mask: np.ndarray = self._get_table_starting_mask(values)
+            for index, rows in enumerate(values.tolist()):
+                try:
+                    len_rows, coefficient = lengths[index], probabilities[index]
+                    if len_rows == 0 or 0 < coefficient < COEFFICIENT_OF_HEADER_PROBABILITY:
+                        self._get_probability_of_header(rows)
+                    if coefficient >= COEFFICIENT_OF_HEADER_PROBABILITY and len_rows >= LEN_COLUMNS_IN_ROW:
+                        if not self.is_all_right_columns(context):
+                            return
+                        if not UnifiedContextProcessor.unified_values(context, token_index):
+                            self.is_lookup_failed = True
+                        self._get_columns_position(rows)
+                        table_starting_mask = self._get_table_starting_mask(values)
+                    elif self._is_table_starting_at(rows, table_starting_mask[index]):
+                        self._get_content_in_table(rows, list_data, context)
+                    else:
+                        count_address = self._get_content_before_table(rows, context, count_address)
+                except Exception as ex:
+                    self.logger.error(
+                        f"Ошибка при обработке файла {self.filename}: {ex}. Предположительно нету ключа tnved_code"
+                    )
+                    self.is_parsed_with_errors = True
+                    self.copy_file_to_dir("errors_excel")
+                    return list_data
         return list_data
 
+    def _get_sheet_score(self, reader: BaseWorkbookReader, sheet: str) -> int:
+        """
+        Getting the number of labels before the table and table headers in the first rows of the sheet.
+        Only the first rows are read, so the rest of the sheet is not parsed.
+        :param reader:
+        :param sheet:
+        :return:
+        """
+        score: int = 0
+        for cell in itertools.chain.from_iterable(reader.get_first_rows(sheet, SHEET_SCAN_ROWS)):
+            if not isinstance(cell, str):
+                continue
+            if (
+                self._remove_spaces_and_symbols(cell) in LABEL_ALIAS_INDEX
+                or self._split_label(cell)[0] in LABEL_ALIAS_INDEX
+                or self._remove_many_spaces(cell) in HEADER_ALIAS_INDEX
+            ):
+                score += 1
+        return score
+
+    def _get_sheets_by_probability(self, reader: BaseWorkbookReader) -> List[str]:
+        """
+        Getting the sheets in the order in which they should be parsed: the most likely sheet with the invoice first.
+        Sheets with the same score keep the order of the workbook.
+        :param reader:
+        :return:
+        """
+        sheets: List[str] = reader.sheet_names
+        if len(sheets) == 1:
+            return sheets
+        scores: Dict[str, int] = {sheet: self._get_sheet_score(reader, sheet) for sheet in sheets}
+        return sorted(sheets, key=lambda sheet: -scores[sheet])
+
+    def collect_companies(self) -> Tuple[List[str], List[str]]:
+        """
+        Getting the companies of the document from the cells before the table in the first rows of the most likely
+        sheet, and the runs of digits in these rows. The rows are read with the stream reader, it does not load
+        the whole workbook. Workbooks parsed earlier are skipped.
+        :return: Companies and runs of digits.
+        """
+        if WorkbookCache.get(self.get_cache_key()) is not None:
+            return [], []
+        with get_workbook_reader(self.get_source(), "stream") as reader:
+            sheet: str = self._get_sheets_by_probability(reader)[0]
+            rows: List[list] = [
+                [cell if isinstance(cell, str) else None for cell in row]
+                for row in reader.get_first_rows(sheet, SHEET_SCAN_ROWS)[1:]
+            ]
+            rows = [row for row in rows if any(cell is not None for cell in row)]
+            if not rows:
+                return [], []
+            values: np.ndarray = StreamWorkbookReader.to_array(rows, max([reader.get_width(sheet), *map(len, rows)]))
+        context: dict = {}
+        count_address: int = 0
+        lengths, probabilities = self._get_probabilities_of_header(values)
+        for index, row in enumerate(values.tolist()):
+            if probabilities[index] >= COEFFICIENT_OF_HEADER_PROBABILITY and lengths[index] >= LEN_COLUMNS_IN_ROW:
+                break
+            count_address = self._get_content_before_table(row, context, count_address)
+        companies: List[str] = [context[company] for company in HEADER_LABELS[:4] if context.get(company)]
+        return companies, re.findall(r"\d+", " ".join(cell for cell in values.ravel().tolist() if cell))
+
     def read_excel_file(self) -> None:
         """
         Read the Excel file.
         :return:
         """
-        list_data: List[dict] = []
+        list_data: RecordSink = self.create_sink()
+        cache_key: str = self.get_cache_key()
+        if (cached_data := WorkbookCache.get(cache_key)) is not None:
+            self.logger.info(f"Файл уже был обработан ранее, данные взяты из кэша. Файл - {self.filename}")
+            for parsed_record in self.refresh_basic_columns(cached_data):
+                list_data.append(parsed_record)
+            self.write_to_file(list_data)
+            return
         try:
-            sheets = pd.ExcelFile(self.filename).sheet_names
-            self.logger.info(f"Sheets is {sheets}")
-            for sheet in sheets:
-                df = pd.read_excel(self.filename, sheet_name=sheet, dtype=str)
-                df = df.dropna(how='all').replace({np.nan: None, "NaT": None})
-                self.parse_rows(df, list_data)
-                if list_data:
-                    break
+            with get_workbook_reader(self.get_source()) as reader:
+                sheets: List[str] = self._get_sheets_by_probability(reader)
+                self.logger.info(f"Sheets is {sheets}")
+                for sheet in sheets:
+                    self.parse_chunks(
+                        reader.get_chunks(sheet), LazyDataFrame(lambda: reader.get_dataframe(sheet)), list_data
+                    )
+                    if list_data:
+                        break
         except Exception as ex:
             self.logger.error(f"Ошибка при чтении файла {self.filename}: {ex}")
+            self.is_parsed_with_errors = True
             self.copy_file_to_dir("errors_excel")
+        if self.is_lookup_failed:
+            self.logger.warning(f"Компании найдены не полностью, файл не сохранен в кэш. Файл - {self.filename}")
+        elif list_data and not self.is_parsed_with_errors:
+            WorkbookCache.add(cache_key, list_data)
         self.write_to_file(list_data)
 
 
+def init_worker(lock: multiprocessing.Lock) -> None:
+    """
+    Initializing the worker process of the pool with the lock shared by all writers of the output directories.
+    :param lock:
+    :return:
+    """
+    global OUTPUT_LOCK
+    OUTPUT_LOCK = lock
+
+
+def parse_workbook(
+    file_path: str,
+    directory: str,
+    input_data: str,
+    content: Optional[bytes] = None,
+    batch: Optional[OutputBatch] = None
+) -> None:
+    """
+    Parse the workbook in the worker process.
+    :param file_path:
+    :param directory:
+    :param input_data:
+    :param content: Content of the workbook, if it was not written to disk.
+    :param batch: The batch the records are appended to instead of a separate file.
+    :return:
+    """
+    data_extractor: DataExtractor = DataExtractor(file_path, directory, input_data, content, batch)
+    data_extractor.read_excel_file()
+    if company_cache_stats := CompanyCache.get_stats():
+        data_extractor.logger.info(f"Статистика кэша компаний в памяти процесса: {company_cache_stats}")
+
+
+def collect_companies(
+    file_path: str,
+    directory: str,
+    input_data: str,
+    content: Optional[bytes] = None
+) -> Tuple[List[str], List[str]]:
+    """
+    Collect the companies of the workbook in the worker process.
+    :param file_path:
+    :param directory:
+    :param input_data:
+    :param content: Content of the workbook, if it was not written to disk.
+    :return:
+    """
+    return DataExtractor(file_path, directory, input_data, content).collect_companies()
+
+
 class ArchiveExtractor:
     def __init__(self, directory: str):
         self.logger: logging.getLogger = get_logger(f"archive_extractor {str(datetime.now().date())}")
         self.input_data: Optional[str] = None
+        self.input_path: Optional[str] = None
         self.root_directory: str = directory
         self.dir_name: str = os.path.join(directory, 'archives')
+        self.settle_tracker: FileSettleTracker = FileSettleTracker()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.futures: Dict[Future, Tuple[str, Optional[bytes], str]] = {}
+        self.pending_workbooks: List[Tuple[str, Optional[bytes], str]] = []
+        self.prefetched_workbooks: List[Tuple[str, Optional[bytes], str]] = []
+        self.prefetch: Optional[Future] = None
+        self.prefetch_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="workbook_prefetch"
+        )
+        self.journal: ProcessingJournal = ProcessingJournal()
+        self.input_id: Optional[str] = None
+        self.batch: Optional[OutputBatch] = None
+        self.members_seen: Dict[str, int] = {}
+        self.depth: int = 0
+        self.members_count: int = 0
+        self.total_size: int = 0
         self.clear_directory()
         self.extension_handlers: dict = {
             '.xlsx': self.read_excel_file,
@@ -404,14 +843,278 @@ class ArchiveExtractor:
             '': self.into_dirs
         }
 
-    def read_excel_file(self, file_path: str) -> None:
+    def read_excel_file(self, file_path: str, content: Optional[bytes] = None) -> None:
         """
         Read the Excel file.
         :param file_path:
+        :param content: Content of the file, if it was read from the archive without writing to disk.
         :return:
         """
         self.logger.info(f"Найден файл Excel: {file_path}")
-        DataExtractor(file_path, self.root_directory, self.input_data).read_excel_file()
+        member: str = self.get_member_key(file_path)
+        if status := self.journal.get_status(self.input_id, member):
+            if status != "started":
+                self.logger.info(f"Файл уже был обработан до перезапуска. Статус - {status}. Файл - {file_path}")
+                return
+        self.journal.set_status(self.input_id, member, "parse", "started")
+        if PREFETCH_COMPANIES:
+            self.pending_workbooks.append((file_path, content, member))
+            if self.is_pending_queue_full():
+                self.parse_pending_workbooks()
+        else:
+            self.parse_member(file_path, content, member)
+
+    def parse_member(self, file_path: str, content: Optional[bytes], member: str) -> None:
+        """
+        Parse the workbook right away or send it to the pool.
+        :param file_path:
+        :param content:
+        :param member: Key of the workbook in the journal.
+        :return:
+        """
+        if WORKERS <= 1:
+            try:
+                parse_workbook(file_path, self.root_directory, self.input_data, content, self.batch)
+            except Exception:
+                self.journal.set_status(self.input_id, member, "parse", "error")
+                raise
+            self.journal.set_status(self.input_id, member, "parse", "done")
+            return
+        self.wait_for_free_slot()
+        if self.executor is None:
+            self.executor = self.create_executor(WORKERS)
+        future: Future = self.executor.submit(
+            parse_workbook, file_path, self.root_directory, self.input_data, content, self.batch
+        )
+        future.add_done_callback(lambda done_future: self.journal_workbook(done_future, member))
+        self.futures[future] = (file_path, content, member)
+
+    def prefetch_companies(self, workbooks: List[Tuple[str, Optional[bytes], str]]) -> Optional[Future]:
+        """
+        Look up the companies of the workbooks at once, before they are parsed. The same companies repeat
+        across the workbooks of an input, so each of them is looked up once, and parsing does not wait for the network.
+        The first rows of the workbooks are scanned right away, the lookups run in the background thread,
+        while the next workbooks are extracted. A workbook that could not be scanned is simply parsed without
+        the prefetch.
+        :param workbooks:
+        :return: The lookups, None if no companies were found.
+        """
+        collected: List[Tuple[List[str], List[str]]] = []
+        if WORKERS <= 1:
+            for file_path, content, _ in workbooks:
+                with contextlib.suppress(Exception):
+                    collected.append(collect_companies(file_path, self.root_directory, self.input_data, content))
+        else:
+            if self.executor is None:
+                self.executor = self.create_executor(WORKERS)
+            futures: List[Future] = [
+                self.executor.submit(collect_companies, file_path, self.root_directory, self.input_data, content)
+                for file_path, content, _ in workbooks
+            ]
+            for future in futures:
+                with contextlib.suppress(Exception):
+                    collected.append(future.result())
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in futures):
+                self.shutdown_executor()
+        companies: Dict[str, set] = {}
+        for company_names, digit_runs in collected:
+            for company_data in company_names:
+                companies.setdefault(company_data, set()).update(digit_runs)
+        self.logger.info(f"Поиск {len(companies)} компаний для {len(workbooks)} файлов Excel")
+        if not companies:
+            return None
+        load_modules(*LOOKUP_MODULES)
+        return self.prefetch_executor.submit(UnifiedContextProcessor.prefetch_companies, companies)
+
+    def is_pending_queue_full(self) -> bool:
+        """
+        Checking whether the queued workbooks should be parsed: there are PREFETCH_QUEUE_SIZE of them,
+        or the contents kept in memory by them and by the workbooks waiting for their lookups take MAX_IN_MEMORY_SIZE.
+        So the extraction of a large input does not pile up its workbooks in memory and the pool gets them
+        while the rest is extracted.
+        :return:
+        """
+        contents_size: int = sum(
+            len(content)
+            for _, content, _ in itertools.chain(self.pending_workbooks, self.prefetched_workbooks)
+            if content is not None
+        )
+        return len(self.pending_workbooks) >= PREFETCH_QUEUE_SIZE or contents_size >= MAX_IN_MEMORY_SIZE
+
+    def parse_pending_workbooks(self) -> None:
+        """
+        Start the lookups of the companies of the queued workbooks, if there are several of them, and parse
+        the workbooks queued before. So the lookups of a batch overlap with the extraction of the next one.
+        :return:
+        """
+        prefetch: Optional[Future] = None
+        try:
+            if len(self.pending_workbooks) > 1:
+                prefetch = self.prefetch_companies(self.pending_workbooks)
+        except Exception as ex:
+            self.logger.error(f"Ошибка при предварительном поиске компаний: {ex}")
+        self.parse_prefetched_workbooks()
+        self.prefetch, self.prefetched_workbooks, self.pending_workbooks = prefetch, self.pending_workbooks, []
+
+    def parse_prefetched_workbooks(self) -> None:
+        """
+        Wait for the lookups of the companies of the previous batch and parse it.
+        A workbook that failed is moved to errors_excel, the rest are parsed anyway.
+        :return:
+        """
+        if self.prefetch is not None:
+            try:
+                self.prefetch.result()
+            except Exception as ex:
+                self.logger.error(f"Ошибка при предварительном поиске компаний: {ex}")
+        prefetched_workbooks, self.prefetched_workbooks, self.prefetch = self.prefetched_workbooks, [], None
+        for file_path, content, member in prefetched_workbooks:
+            try:
+                self.parse_member(file_path, content, member)
+            except Exception as ex:
+                self.journal.set_status(self.input_id, member, "parse", "error")
+                self.reject_workbook(file_path, content, ex)
+
+    def get_member_key(self, file_path: str) -> str:
+        """
+        Getting the key of the member in the journal. The same path can be met several times within one input
+        (e.g. in different nested archives), so the occurrence number is added to it.
+        :param file_path:
+        :return:
+        """
+        member: str = os.path.relpath(file_path, self.root_directory)
+        self.members_seen[member] = self.members_seen.get(member, 0) + 1
+        return f"{member}#{self.members_seen[member]}"
+
+    def journal_workbook(self, future: Future, member: str) -> None:
+        """
+        Saving the result of the workbook parsed in the pool to the journal as soon as it is finished.
+        Workbooks lost with a broken pool stay started, since they are parsed again.
+        :param future:
+        :param member:
+        :return:
+        """
+        if future.cancelled() or isinstance(future.exception(), BrokenProcessPool):
+            return
+        self.journal.set_status(self.input_id, member, "parse", "error" if future.exception() else "done")
+
+    @staticmethod
+    def create_executor(max_workers: int) -> ProcessPoolExecutor:
+        """
+        Create a pool of processes for parsing workbooks.
+        :param max_workers:
+        :return:
+        """
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(OUTPUT_LOCK,))
+
+    def shutdown_executor(self) -> None:
+        """
+        Shut down the pool of processes.
+        :return:
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def reject_workbook(self, file_path: str, content: Optional[bytes], ex: BaseException) -> None:
+        """
+        Copy the workbook, which could not be parsed, to the errors_excel directory.
+        :param file_path:
+        :param content:
+        :param ex:
+        :return:
+        """
+        self.logger.error(f"Ошибка при обработке файла {file_path}: {ex}")
+        with contextlib.suppress(Exception):
+            DataExtractor(file_path, self.root_directory, self.input_data, content).copy_file_to_dir("errors_excel")
+
+    def wait_for_free_slot(self) -> None:
+        """
+        Wait until there are less than MAX_QUEUED_WORKBOOKS workbooks in the pool. The finished ones are collected
+        right away, so that the contents of the in-memory members are released as soon as they are parsed.
+        :return:
+        """
+        self.collect_workbooks([future for future in self.futures if future.done()])
+        while len(self.futures) >= MAX_QUEUED_WORKBOOKS:
+            done_futures, _ = wait(self.futures, return_when=FIRST_COMPLETED)
+            self.collect_workbooks(list(done_futures))
+
+    def wait_workbooks(self) -> None:
+        """
+        Wait for all workbooks sent to the pool.
+        :return:
+        """
+        self.collect_workbooks(list(self.futures))
+
+    def cancel_workbooks(self) -> None:
+        """
+        Cancel the workbooks of the rejected input: the queued ones are dropped, the ones in the pool are cancelled.
+        Those already being parsed can not be stopped, they are waited for.
+        :return:
+        """
+        self.pending_workbooks.clear()
+        self.prefetched_workbooks.clear()
+        self.prefetch = None
+        for future in self.futures:
+            future.cancel()
+        wait(self.futures)
+        self.futures.clear()
+
+    def collect_workbooks(self, futures: List[Future]) -> None:
+        """
+        Collect the finished workbooks of the pool. If a worker process died, the pool is recreated
+        and the workbooks it took down with it are parsed again one by one, so that only the bad one is rejected.
+        :param futures:
+        :return:
+        """
+        broken_files: List[Tuple[str, Optional[bytes], str]] = []
+        while futures:
+            for future in futures:
+                file_path, content, member = self.futures.pop(future)
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    broken_files.append((file_path, content, member))
+                except Exception as ex:
+                    self.reject_workbook(file_path, content, ex)
+            if broken_files:
+                # The other workbooks of the broken pool are finished or lost as well
+                self.shutdown_executor()
+            futures = list(self.futures) if broken_files else []
+        if not broken_files:
+            return
+        for file_path, content, member in broken_files:
+            with self.create_executor(1) as executor:
+                try:
+                    executor.submit(
+                        parse_workbook, file_path, self.root_directory, self.input_data, content, self.batch
+                    ).result()
+                    self.journal.set_status(self.input_id, member, "parse", "done")
+                except Exception as ex:
+                    self.journal.set_status(self.input_id, member, "parse", "error")
+                    self.reject_workbook(file_path, content, ex)
+
+    def start_batch(self, name: str, key: str) -> None:
+        """
+        Start collecting the records of all workbooks in one file of the json directory.
+        :param name: Name of the output file.
+        :param key: Key of the batch. The same key continues the batch left after a restart.
+        :return:
+        """
+        self.batch = OutputBatch(os.path.join(self.root_directory, 'json'), name, key)
+
+    def finish_batch(self) -> None:
+        """
+        Give the batch its name in the json directory.
+        :return:
+        """
+        if self.batch is None:
+            return
+        with OUTPUT_LOCK:
+            output_file_path: Optional[str] = self.batch.finalize()
+        if output_file_path:
+            self.logger.info(f"Пакет сохранён как {output_file_path}")
+        self.batch = None
 
     def clear_directory(self) -> None:
         """
@@ -422,6 +1125,57 @@ class ArchiveExtractor:
             shutil.rmtree(self.dir_name)
         os.makedirs(self.dir_name, exist_ok=True)
 
+    @staticmethod
+    def is_read_in_memory(file_name: str, file_size: int) -> bool:
+        """
+        Checking whether the member of the archive is an Excel file that can be parsed right from memory.
+        :param file_name:
+        :param file_size: Uncompressed size of the member.
+        :return:
+        """
+        return os.path.splitext(file_name)[1].lower() in EXCEL_EXTENSIONS and file_size <= MAX_IN_MEMORY_SIZE
+
+    @staticmethod
+    def copy_stream(source: IO[bytes], destination: IO[bytes], file_size: int) -> None:
+        """
+        Copy the member of the archive in chunks, so that it is never loaded into memory as a whole.
+        :param source:
+        :param destination:
+        :param file_size: Uncompressed size declared in the archive. Copying more than that is refused.
+        :return:
+        """
+        copied_size: int = 0
+        while chunk := source.read(CHUNK_SIZE):
+            copied_size += len(chunk)
+            if copied_size > file_size:
+                raise ArchiveLimitExceeded(f"Размер файла больше заявленного в архиве ({file_size} байт)")
+            destination.write(chunk)
+
+    def check_limits(self, archive_file: str, file_sizes: List[int]) -> None:
+        """
+        Check the limits of the archive being extracted: the nesting depth, the number of members
+        and the total uncompressed size of everything extracted from the input file.
+        :param archive_file:
+        :param file_sizes: Uncompressed sizes of the archive members.
+        :return:
+        """
+        self.members_count += len(file_sizes)
+        self.total_size += sum(file_sizes)
+        if self.depth > MAX_ARCHIVE_DEPTH:
+            raise ArchiveLimitExceeded(
+                f"Превышена глубина вложенности архивов ({MAX_ARCHIVE_DEPTH}). Архив - {archive_file}"
+            )
+        if self.members_count > MAX_MEMBERS_COUNT:
+            raise ArchiveLimitExceeded(
+                f"Превышено количество файлов в архиве ({self.members_count} > {MAX_MEMBERS_COUNT}). "
+                f"Архив - {archive_file}"
+            )
+        if self.total_size > MAX_UNCOMPRESSED_SIZE:
+            raise ArchiveLimitExceeded(
+                f"Превышен размер распакованных данных ({self.total_size} > {MAX_UNCOMPRESSED_SIZE} байт). "
+                f"Архив - {archive_file}"
+            )
+
     def save_archive(
         self,
         archive: Union[rarfile.RarFile, zipfile.ZipFile],
@@ -439,14 +1193,45 @@ class ArchiveExtractor:
         inner_archive_filename = os.path.join(self.dir_name, extract_to, os.path.basename(file_info.filename))
         os.makedirs(os.path.dirname(inner_archive_filename), exist_ok=True)
         try:
-            inner_archive_file = archive.open(file_info.filename)
-            with open(inner_archive_filename, 'wb') as f:
-                f.write(inner_archive_file.read())
-            inner_archive_file.close()
+            with archive.open(file_info.filename) as inner_archive_file, open(inner_archive_filename, 'wb') as f:
+                self.copy_stream(inner_archive_file, f, file_info.file_size)
             return inner_archive_filename
+        except ArchiveLimitExceeded:
+            raise
         except Exception as ex:
             self.logger.error(f"Ошибка при извлечении файла {file_info.filename}: {ex}")
 
+    def process_member(
+        self,
+        archive: Union[rarfile.RarFile, zipfile.ZipFile],
+        file_info: Union[rarfile.RarInfo, zipfile.ZipInfo]
+    ) -> None:
+        """
+        Process the member of the archive. Excel files are parsed right from the archive stream,
+        everything else is saved to disk and processed as usual.
+        :param archive:
+        :param file_info:
+        :return:
+        """
+        if file_info.is_dir():
+            return
+        if self.is_read_in_memory(file_info.filename, file_info.file_size):
+            try:
+                with archive.open(file_info.filename) as inner_archive_file:
+                    content: bytes = inner_archive_file.read(file_info.file_size + 1)
+                if len(content) > file_info.file_size:
+                    raise ArchiveLimitExceeded(
+                        f"Размер файла {file_info.filename} больше заявленного в архиве ({file_info.file_size} байт)"
+                    )
+            except ArchiveLimitExceeded:
+                raise
+            except Exception as ex:
+                self.logger.error(f"Ошибка при извлечении файла {file_info.filename}: {ex}")
+                return
+            self.read_excel_file(os.path.join(self.dir_name, file_info.filename), content)
+        elif inner_archive_filename := self.save_archive(archive, file_info):
+            self.process_archive(inner_archive_filename)
+
     def into_dirs(self, dir_name: str) -> None:
         """
         Entry to dir.
@@ -457,36 +1242,95 @@ class ArchiveExtractor:
             item_path = os.path.join(dir_name, item)
             self.process_archive(item_path)
 
+    def process_content(self, file_path: str, content: bytes) -> None:
+        """
+        Process the member of the archive that was read into memory.
+        Excel files are parsed from memory, everything else is saved to disk and processed as usual.
+        :param file_path:
+        :param content:
+        :return:
+        """
+        if self.is_read_in_memory(file_path, len(content)):
+            self.read_excel_file(file_path, content)
+            return
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        self.process_archive(file_path)
+
+    def process_extracted_member(self, file_path: str, content: Optional[bytes]) -> None:
+        """
+        Process the member extracted from the archive, into memory or to disk.
+        An error in one member does not stop the processing of the others.
+        :param file_path:
+        :param content: Content of the member read into memory, None if it is extracted to disk.
+        :return:
+        """
+        try:
+            if content is not None:
+                self.process_content(file_path, content)
+            elif os.path.exists(file_path):
+                self.process_archive(file_path)
+        except ArchiveLimitExceeded:
+            raise
+        except Exception as ex:
+            self.logger.error(f"Ошибка при обработке файла {file_path}: {ex}")
+
     def seven_zip_archive(self, seven_zip_file: str) -> None:
         """
         Extract and process a 7z archive.
+        The archive is decompressed in a single pass: into memory, if it is small enough, otherwise to disk.
+        If the pass fails, the members are extracted one by one, so that a broken member does not lose the others.
         :param seven_zip_file: Path to the 7z archive file.
         :return:
         """
         self.logger.info(f"Найден архив: {seven_zip_file}")
-        file_list: list = py7zr.SevenZipFile(seven_zip_file, 'r').getnames()  # Получаем список файлов
-        for file_name in file_list:
-            extract_path: str = os.path.join(self.dir_name, os.path.dirname(file_name))
-            os.makedirs(extract_path, exist_ok=True)
+        contents: Dict[str, io.BytesIO] = {}
+        with py7zr.SevenZipFile(seven_zip_file, 'r') as seven_zip_ref:
+            file_list: list = [file_info for file_info in seven_zip_ref.list() if not file_info.is_directory]
+            self.check_limits(seven_zip_file, [file_info.uncompressed for file_info in file_list])
             try:
-                with py7zr.SevenZipFile(seven_zip_file, 'r') as seven_zip_ref:
-                    seven_zip_ref.extract(targets=[file_name], path=extract_path)  # Извлекаем файл
-                extracted_file_path: str = os.path.join(extract_path, file_name)
-                self.process_archive(extracted_file_path)
+                if sum(file_info.uncompressed for file_info in file_list) <= MAX_IN_MEMORY_SIZE:
+                    contents = seven_zip_ref.readall() or {}
+                else:
+                    seven_zip_ref.extractall(path=self.dir_name)
             except Exception as ex:
-                self.logger.error(f"Ошибка при извлечении файла {file_name}: {ex}")
+                self.logger.error(f"Ошибка при распаковке архива {seven_zip_file}: {ex}. Файлы извлекаются по одному")
+                contents = {}
+                for file_info in file_list:
+                    try:
+                        seven_zip_ref.reset()
+                        seven_zip_ref.extract(path=self.dir_name, targets=[file_info.filename])
+                    except Exception as member_ex:
+                        self.logger.error(f"Ошибка при извлечении файла {file_info.filename}: {member_ex}")
+        for file_info in file_list:
+            content: Optional[io.BytesIO] = contents.pop(file_info.filename, None)
+            self.process_extracted_member(
+                os.path.join(self.dir_name, file_info.filename), content.read() if content else None
+            )
 
     def unrar_archive(self, rar_file: str) -> None:
         """
-        Unrar the archive.
+        Unrar the archive. All members are extracted with a single call of unrar.
+        If the call fails, the members are extracted one by one, so that a broken member does not lose the others.
         :param rar_file:
         :return:
         """
         self.logger.info(f"Найден архив: {rar_file}")
         with rarfile.RarFile(rar_file, 'r') as rar_ref:
-            for file_info in rar_ref.infolist():
-                if inner_rar_filename := self.save_archive(rar_ref, file_info):
-                    self.process_archive(inner_rar_filename)
+            file_list: list = [file_info for file_info in rar_ref.infolist() if not file_info.is_dir()]
+            self.check_limits(rar_file, [file_info.file_size for file_info in file_list])
+            try:
+                rar_ref.extractall(path=self.dir_name)
+            except Exception as ex:
+                self.logger.error(f"Ошибка при распаковке архива {rar_file}: {ex}. Файлы извлекаются по одному")
+                for file_info in file_list:
+                    try:
+                        rar_ref.extract(file_info, path=self.dir_name)
+                    except Exception as member_ex:
+                        self.logger.error(f"Ошибка при извлечении файла {file_info.filename}: {member_ex}")
+        for file_info in file_list:
+            self.process_extracted_member(os.path.join(self.dir_name, file_info.filename), None)
 
     def unzip_archive(self, zip_file: str) -> None:
         """
@@ -496,9 +1340,10 @@ class ArchiveExtractor:
         """
         self.logger.info(f"Найден архив: {zip_file}")
         with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            for file_info in zip_ref.infolist():
-                if inner_zip_filename := self.save_archive(zip_ref, file_info):
-                    self.process_archive(inner_zip_filename)
+            file_list: list = zip_ref.infolist()
+            self.check_limits(zip_file, [file_info.file_size for file_info in file_list if not file_info.is_dir()])
+            for file_info in file_list:
+                self.process_member(zip_ref, file_info)
 
     def process_archive(self, file_path: str) -> None:
         """
@@ -513,47 +1358,138 @@ class ArchiveExtractor:
         ext: str = ext.lower()
         handler: Callable[[str], None]
         if handler := self.extension_handlers.get(ext):
+            depth: int = self.depth
+            if ext in ARCHIVE_EXTENSIONS:
+                self.depth += 1
             try:
                 handler(file_path)
+            except ArchiveLimitExceeded as ex:
+                if depth:
+                    raise
+                self.logger.error(f"Архив отклонён: {ex}")
+                if file_path == self.input_path:
+                    self.cancel_workbooks()
+                self.move_to_errors(file_path)
             except Exception as ex:
                 logger.error(f"Exception is {ex}.")
-                errors: str = os.path.join(self.root_directory, "errors")
-                os.makedirs(errors, exist_ok=True)
-                os.rename(file_path, os.path.join(errors, os.path.basename(file_path)))
+                self.move_to_errors(file_path)
+            finally:
+                self.depth = depth
         else:
             self.logger.info(f"Найден файл: {file_path}")
 
+    def move_to_errors(self, file_path: str) -> None:
+        """
+        Move the file to the errors directory.
+        :param file_path:
+        :return:
+        """
+        errors: str = os.path.join(self.root_directory, "errors")
+        os.makedirs(errors, exist_ok=True)
+        os.rename(file_path, os.path.join(errors, os.path.basename(file_path)))
+
+    def get_input_files(self) -> List[str]:
+        """
+        Getting the files and directories uploaded to the root directory.
+        :return:
+        """
+        for _, dirs, files in os.walk(self.root_directory):
+            return [
+                os.path.join(self.root_directory, file)
+                for file in files + list(set(dirs) - set(BASE_DIRECTORIES))
+            ]
+        return []
+
+    def process_input(self, file_path: str) -> None:
+        """
+        Process the uploaded file and move it to the done directory.
+        :param file_path:
+        :return:
+        """
+        file: str = os.path.basename(file_path)
+        self.input_data = file
+        self.input_path = file_path
+        self.input_id = self.get_input_id(file_path)
+        self.depth, self.members_count, self.total_size = 0, 0, 0
+        self.members_seen.clear()
+        is_own_batch: bool = self.batch is None and OUTPUT_BATCH in ("input", "run")
+        if is_own_batch:
+            self.start_batch(file, self.input_id)
+        self.journal.set_status(self.input_id, "", "input", "started")
+        try:
+            self.process_archive(file_path)
+        finally:
+            self.parse_pending_workbooks()
+            self.parse_prefetched_workbooks()
+            self.wait_workbooks()
+            if is_own_batch:
+                self.finish_batch()
+        if os.path.exists(file_path):
+            done: str = os.path.join(self.root_directory, "done")
+            os.makedirs(done, exist_ok=True)
+            os.rename(file_path, os.path.join(done, file))
+        self.journal.remove(self.input_id)
+
     @staticmethod
-    def is_file_fully_loaded(file_path: str, wait_time: int = 10) -> bool:
+    def get_input_id(file_path: str) -> str:
         """
-        Check if a file is fully loaded by comparing its size over time.
-        :param file_path: Path to the file to check
-        :param wait_time: Time to wait between size checks (in seconds)
-        :return: True if the file is fully loaded, False otherwise
+        Getting the key of the input in the journal. The size and mtime distinguish a new upload with the same name.
+        :param file_path:
+        :return:
         """
-        initial_size = os.path.getsize(file_path)
-        time.sleep(wait_time)
-        final_size = os.path.getsize(file_path)
-        return initial_size == final_size
+        size, mtime = FileSettleTracker.get_signature(file_path) or (0, 0)
+        return f"{os.path.basename(file_path)}:{size}:{mtime}"
 
     def main(self) -> None:
         """
-        Main function.
+        Main function. With XL_IDP_OUTPUT_BATCH=run the records of all inputs are written to one file.
+        The key of the run batch does not change, so a run interrupted by a crash is continued by the next one
+        together with the records of the inputs it has already finished.
         :return:
         """
-        for _, dirs, files in os.walk(self.root_directory):
-            for file in files + list(set(dirs) - set(BASE_DIRECTORIES)):
-                file_path: str = os.path.join(self.root_directory, file)
+        if OUTPUT_BATCH == "run":
+            self.start_batch(f"run_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}", "run")
+        try:
+            for file_path in self.settle_tracker.wait_for_settled(self.get_input_files()):
+                self.process_input(file_path)
+        finally:
+            self.shutdown_executor()
+            self.prefetch_executor.shutdown(wait=True)
+            self.finish_batch()
 
-                # Check if the file is fully loaded
-                if self.is_file_fully_loaded(file_path, wait_time=WAITING_TIME):
-                    self.input_data = file
-                    self.process_archive(file_path)
-                    done: str = os.path.join(self.root_directory, "done")
-                    os.makedirs(done, exist_ok=True)
-                    os.rename(file_path, os.path.join(done, file))
-            break
+    def serve(self) -> None:
+        """
+        Resident mode: waits for new files and processes each of them as soon as it is fully loaded.
+        :return:
+        """
+        event_source: ScanEventSource = get_event_source(self.root_directory)
+        self.logger.info(f"Служба запущена. Источник событий - {type(event_source).__name__}")
+        for file_path in self.get_input_files():
+            self.settle_tracker.add(file_path)
+        try:
+            while True:
+                for file_path, is_closed in event_source.read(self.settle_tracker.get_timeout()).items():
+                    self.settle_tracker.add(file_path, is_closed)
+                for file_path in self.settle_tracker.poll():
+                    try:
+                        self.process_input(file_path)
+                    except Exception as ex:
+                        self.logger.error(f"Ошибка при обработке файла {file_path}: {ex}")
+                        with contextlib.suppress(FileNotFoundError):
+                            self.move_to_errors(file_path)
+                    self.clear_directory()
+        finally:
+            event_source.close()
+            self.shutdown_executor()
+            self.prefetch_executor.shutdown(wait=True)
 
 
 if __name__ == '__main__':
-    ArchiveExtractor(os.environ["XL_IDP_PATH_UNZIPPING"]).main()
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", help="Stay up and process new files as they arrive")
+    args: argparse.Namespace = parser.parse_args()
+    archive_extractor: ArchiveExtractor = ArchiveExtractor(os.environ["XL_IDP_PATH_UNZIPPING"])
+    if args.daemon:
+        archive_extractor.serve()
+    else:
+        archive_extractor.main()
@@ -0,0 +1,225 @@
+import json
+import shutil
+import hashlib
+import tempfile
+from __init__ import *
+from typing import IO, Dict, List, Type, Optional
+
+
+class RecordSink:
+    """
+    Writes the records of one workbook to a temporary file in the output directory as soon as they are parsed.
+    The layout is a JSON array with indent 4, the same as json.dump of the list of records.
+    Only the counters and the records for the workbook cache (up to WORKBOOK_CACHE_MAX_RECORDS) are kept in memory.
+    """
+    extension: str = ".json"
+
+    def __init__(self, directory: Optional[str], encoder: Optional[Type[json.JSONEncoder]] = None):
+        self.directory: str = directory
+        self.encoder: Optional[Type[json.JSONEncoder]] = encoder
+        self.file: Optional[IO[str]] = None
+        self.records_count: int = 0
+        self.contexts_count: int = 0
+        self.last_context: Optional[dict] = None
+        self.document: Optional[Dict[str, list]] = {"contexts": [], "items": []}
+
+    def __len__(self) -> int:
+        return self.records_count
+
+    @staticmethod
+    def split_record(record: dict) -> Tuple[dict, dict]:
+        """
+        Splitting the record into the context of the document and the values of the item.
+        :param record:
+        :return:
+        """
+        context: dict = {key: value for key, value in record.items() if key not in ITEM_COLUMNS}
+        item: dict = {key: value for key, value in record.items() if key in ITEM_COLUMNS}
+        return context, item
+
+    def open(self) -> IO[str]:
+        """
+        Creating the temporary file on the first record. It is hidden until the workbook is processed.
+        :return:
+        """
+        if self.file is None:
+            if self.directory is not None:
+                os.makedirs(self.directory, exist_ok=True)
+            self.file = tempfile.NamedTemporaryFile(
+                'w', encoding='utf-8', dir=self.directory, prefix='.', suffix='.part', delete=False
+            )
+        return self.file
+
+    def append(self, record: dict) -> None:
+        """
+        Writing the record.
+        :param record:
+        :return:
+        """
+        context, item = self.split_record(record)
+        if self.last_context is None or self.last_context != context:
+            self.last_context = context
+            self.contexts_count += 1
+            self.write_context(self.contexts_count - 1, context)
+        self.records_count += 1
+        self.write_record(self.contexts_count - 1, record, item)
+        self.keep_record(context, item)
+
+    def keep_record(self, context: dict, item: dict) -> None:
+        """
+        Keeping the record in the compact form for the workbook cache. The workbook with more than
+        WORKBOOK_CACHE_MAX_RECORDS records is not cached, so that the memory does not grow with its rows.
+        :param context:
+        :param item:
+        :return:
+        """
+        if self.document is None:
+            return
+        if self.records_count > WORKBOOK_CACHE_MAX_RECORDS:
+            self.document = None
+            return
+        if len(self.document["contexts"]) < self.contexts_count:
+            self.document["contexts"].append(context)
+        self.document["items"].append([self.contexts_count - 1, item])
+
+    def write_context(self, context_id: int, context: dict) -> None:
+        pass
+
+    def write_record(self, context_id: int, record: dict, item: dict) -> None:
+        text: str = json.dumps(record, ensure_ascii=False, indent=4, cls=self.encoder).replace("\n", "\n    ")
+        self.open().write(f"{',' if self.records_count > 1 else '['}\n    {text}")
+
+    def close(self) -> None:
+        self.open().write("\n]")
+        self.file.close()
+
+    def get_document(self) -> Optional[Dict[str, list]]:
+        """
+        Getting the records in the compact form: the contexts and the items that reference them.
+        :return: The records or None, if there were too many of them to keep.
+        """
+        return self.document
+
+    def finalize(self, output_file_path: str) -> None:
+        """
+        Closing the temporary file and moving it to the output file in one step.
+        :param output_file_path:
+        :return:
+        """
+        self.close()
+        os.replace(self.file.name, output_file_path)
+
+    def discard(self) -> None:
+        """
+        Removing the temporary file, if the records are not needed.
+        :return:
+        """
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.file.name)
+
+
+class NdjsonSink(RecordSink):
+    """
+    Writes each record as a line of JSON.
+    """
+    extension: str = ".ndjson"
+
+    def write_record(self, context_id: int, record: dict, item: dict) -> None:
+        self.open().write(f"{json.dumps(record, ensure_ascii=False, cls=self.encoder)}\n")
+
+    def close(self) -> None:
+        self.open().close()
+
+
+class CompactSink(NdjsonSink):
+    """
+    Writes the context of the document once and the items with a reference to it, each as a line of JSON.
+    """
+    extension: str = ".compact.ndjson"
+
+    def write_context(self, context_id: int, context: dict) -> None:
+        line: str = json.dumps({'context_id': context_id, 'context': context}, ensure_ascii=False, cls=self.encoder)
+        self.open().write(f"{line}\n")
+
+    def write_record(self, context_id: int, record: dict, item: dict) -> None:
+        self.open().write(f"{json.dumps({'context_id': context_id, **item}, ensure_ascii=False, cls=self.encoder)}\n")
+
+
+class OutputBatch:
+    """
+    One rolling NDJSON file in the output directory for all workbooks of an input or of a run.
+    The records of each workbook are appended at once, the file gets its name when the batch is finished.
+    The name of the temporary file depends only on the key, not on the name of the output file,
+    so the batch with the same key continues after a restart.
+    """
+    extension: str = ".ndjson"
+
+    def __init__(self, directory: str, name: str, key: str):
+        self.directory: str = directory
+        self.name: str = name
+        digest: str = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self.path: str = os.path.join(directory, f".batch.{digest}{self.extension}.part")
+
+    def append(self, sink: RecordSink) -> None:
+        """
+        Moving the records of the workbook from its temporary file to the batch. It is called under the output lock.
+        :param sink:
+        :return:
+        """
+        sink.close()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(sink.file.name, 'rb') as source, open(self.path, 'ab') as destination:
+            shutil.copyfileobj(source, destination, pow(1024, 2))
+        os.remove(sink.file.name)
+
+    def get_output_path(self) -> str:
+        """
+        Getting the name of the output file. The suffix (_1, _2, etc.) is added, if the file already exists.
+        :return:
+        """
+        output_file_path: str = os.path.join(self.directory, f"{self.name}{self.extension}")
+        counter: int = 1
+        while os.path.exists(output_file_path):
+            output_file_path = os.path.join(self.directory, f"{self.name}_{counter}{self.extension}")
+            counter += 1
+        return output_file_path
+
+    def finalize(self) -> Optional[str]:
+        """
+        Moving the batch to the output file in one step.
+        :return: The output file or None, if no records were written.
+        """
+        if not os.path.exists(self.path):
+            return None
+        output_file_path: str = self.get_output_path()
+        os.replace(self.path, output_file_path)
+        return output_file_path
+
+
+def expand_document(document: Dict[str, list]) -> List[dict]:
+    """
+    Getting the records from the compact form.
+    :param document:
+    :return:
+    """
+    return [{**document["contexts"][context_id], **item} for context_id, item in document["items"]]
+
+
+def get_record_sink(
+    directory: Optional[str],
+    encoder: Optional[Type[json.JSONEncoder]] = None,
+    is_batched: bool = False
+) -> RecordSink:
+    """
+    Getting the sink of the records set by XL_IDP_OUTPUT_FORMAT: json, ndjson or compact.
+    The records of a batch are always written as NDJSON, since they are concatenated.
+    :param directory: Output directory. None means the system temporary directory.
+    :param encoder: Encoder of the values that json does not support.
+    :param is_batched: The records are appended to the batch.
+    :return:
+    """
+    if is_batched:
+        return NdjsonSink(directory, encoder)
+    sinks: Dict[str, type] = {"json": RecordSink, "ndjson": NdjsonSink, "compact": CompactSink}
+    return sinks.get(OUTPUT_FORMAT, RecordSink)(directory, encoder)
@@ -1,30 +1,327 @@
+from __future__ import annotations
+
 import re
 import abc
+import json
 import time
-import httpx
+import atexit
 import sqlite3
-import requests
+import threading
 import contextlib
+import importlib.util
 from __init__ import *
 from pathlib import Path
 from functools import reduce
-from pandas import DataFrame
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from bs4 import BeautifulSoup
 from operator import add, mul
-from stdnum.exceptions import *
-from dadata.sync import DadataClient
-from requests import Response, Session
-from stdnum.util import clean, isdigits
 import xml.etree.ElementTree as ElemTree
-from typing import Union, List, Optional
-from deep_translator import GoogleTranslator
+from typing import Dict, Tuple, Union, List, Optional
+
+bs4 = lazy_import("bs4")
+httpx = lazy_import("httpx")
+dadata = lazy_import("dadata")
+deep_translator = lazy_import("deep_translator")
+LOOKUP_MODULES: Tuple[types.ModuleType, ...] = (bs4, httpx, dadata, deep_translator)
+
+logger: LazyLogger = LazyLogger(f"unified_companies {str(datetime.now().date())}")
+
+
+class WorkbookTokenIndex:
+    """
+    Index of the cells of the sheet for the search of taxpayer IDs in the invoice.
+    It is built on the first search and answers all searches in the sheet. The companies of a document
+    are looked up in several threads, so the index is built under the lock, once.
+    """
+    separator: str = "\x00"
+
+    def __init__(self, df: pd.DataFrame):
+        self.df: pd.DataFrame = df
+        self.text: Optional[str] = None
+        self.digit_runs: set = set()
+        self.is_built: bool = False
+        self.lock: threading.Lock = threading.Lock()
+
+    def build(self) -> None:
+        """
+        Joining the lowercased cells into one text and collecting the runs of digits in them.
+        :return:
+        """
+        if self.is_built:
+            return
+        with self.lock:
+            if self.is_built:
+                return
+            cells: list = [str(cell).lower() for cell in self.df.to_numpy(dtype=object).ravel().tolist()]
+            self.text = self.separator.join(cells) if cells else None
+            self.digit_runs = set(re.findall(r"\d+", self.text)) if cells else set()
+            self.is_built = True
+
+    def find_key(self, search_dict: dict) -> Optional[str]:
+        """
+        Finding the first key that is contained in any cell of the sheet.
+        :param search_dict:
+        :return:
+        """
+        self.build()
+        if self.text is None:
+            return None
+        for key in search_dict:
+            if key in self.digit_runs or (self.separator not in key and key in self.text):
+                return key
+        return None
+
+
+class CacheConnection:
+    """
+    The connection to cache.db shared by all caches of the process. It is opened once per process,
+    since pool workers are forked, and every table is created once. Statements go through the lock,
+    so that the connection can be used from several threads.
+    """
+    lock: threading.RLock = threading.RLock()
+    conn: Optional[sqlite3.Connection] = None
+    pid: Optional[int] = None
+    tables: set = set()
+
+    @classmethod
+    def get(cls) -> sqlite3.Connection:
+        """
+        Getting the connection of the current process.
+        :return:
+        """
+        with cls.lock:
+            if cls.conn is None or cls.pid != os.getpid():
+                cls.conn = sqlite3.connect(
+                    BaseUnifiedCompanies.create_file_for_cache(), timeout=30, check_same_thread=False
+                )
+                cls.pid = os.getpid()
+                cls.tables = set()
+            return cls.conn
+
+    @classmethod
+    def reset_after_fork(cls) -> None:
+        """
+        Dropping the connection and the lock inherited from the parent process, the lock may be held by its thread.
+        :return:
+        """
+        cls.lock = threading.RLock()
+        cls.conn = None
 
+    @classmethod
+    def add_column(cls, table_name: str, column: str, default: Optional[object] = None) -> None:
+        """
+        Adding the column to the table created by an earlier version, if it is missing.
+        The existing rows get the default value in the same transaction.
+        :param table_name:
+        :param column: Name and type of the column.
+        :param default:
+        :return:
+        """
+        with cls.lock:
+            conn: sqlite3.Connection = cls.get()
+            if f"{table_name}.{column}" not in cls.tables:
+                column_name: str = column.split()[0]
+                columns: list = [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+                if column_name not in columns:
+                    conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN {column}')
+                    conn.execute(
+                        f'UPDATE "{table_name}" SET {column_name}=? WHERE {column_name} IS NULL', (default,)
+                    )
+                    conn.commit()
+                cls.tables.add(f"{table_name}.{column}")
+
+    @classmethod
+    def create_table(cls, table_name: str, columns: str) -> None:
+        """
+        Creating the table, if it has not been created by this process yet.
+        :param table_name:
+        :param columns:
+        :return:
+        """
+        with cls.lock:
+            conn: sqlite3.Connection = cls.get()
+            if table_name not in cls.tables:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name}({columns})")
+                conn.commit()
+                cls.tables.add(table_name)
+
+    @classmethod
+    def fetch_one(cls, query: str, parameters: tuple) -> Optional[tuple]:
+        """
+        Getting the first row of the query.
+        :param query:
+        :param parameters:
+        :return:
+        """
+        with cls.lock:
+            return cls.get().execute(query, parameters).fetchone()
 
-logger = get_logger(f"unified_companies {str(datetime.now().date())}")
+    @classmethod
+    def execute(cls, query: str, parameters: tuple) -> None:
+        """
+        Executing the statement and committing it.
+        :param query:
+        :param parameters:
+        :return:
+        """
+        with cls.lock:
+            conn: sqlite3.Connection = cls.get()
+            conn.execute(query, parameters)
+            conn.commit()
+
+
+class CompanyCache:
+    """
+    In-memory tier of a company cache table: the rows used last, each until its expiry time.
+    The rows without a company name are the companies that were not found (negative results).
+    """
+    lock: threading.Lock = threading.Lock()
+    instances: Dict[str, CompanyCache] = {}
+
+    def __init__(self, maxsize: int):
+        self.maxsize: int = maxsize
+        self.rows: OrderedDict = OrderedDict()
+        self.stats: Dict[str, int] = dict.fromkeys(("hits", "negative_hits", "misses", "expired", "evictions"), 0)
+
+    @classmethod
+    def get_instance(cls, table_name: str) -> CompanyCache:
+        """
+        Getting the cache of the table in the process.
+        :param table_name:
+        :return:
+        """
+        with cls.lock:
+            if table_name not in cls.instances:
+                cls.instances[table_name] = cls(COMPANY_CACHE_SIZE)
+            return cls.instances[table_name]
+
+    @classmethod
+    def reset_after_fork(cls) -> None:
+        cls.lock = threading.Lock()
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Dict[str, int]]:
+        """
+        Getting the counters of all tables.
+        :return:
+        """
+        with cls.lock:
+            return {table_name: dict(cache.stats) for table_name, cache in cls.instances.items()}
+
+    def get(self, key: str) -> Optional[tuple]:
+        """
+        Getting the row, if it has not expired.
+        :param key:
+        :return:
+        """
+        with self.lock:
+            if key not in self.rows:
+                self.stats["misses"] += 1
+                return None
+            row, expires_at = self.rows[key]
+            if expires_at <= time.time():
+                del self.rows[key]
+                self.stats["expired"] += 1
+                return None
+            self.rows.move_to_end(key)
+            self.stats["hits" if row[1] is not None else "negative_hits"] += 1
+            return row
+
+    def put(self, key: str, row: tuple, expires_at: float) -> None:
+        """
+        Saving the row. The row used longest ago is evicted, when the size is exceeded.
+        :param key:
+        :param row:
+        :param expires_at:
+        :return:
+        """
+        with self.lock:
+            self.rows[key] = (row, expires_at)
+            self.rows.move_to_end(key)
+            if len(self.rows) > self.maxsize:
+                self.rows.popitem(last=False)
+                self.stats["evictions"] += 1
+
+
+class HttpClients:
+    """
+    Long-lived HTTP clients of the process, one per provider and proxy, so that the connections and their TLS
+    sessions are kept alive between the lookups. HTTP/2 is used, when the h2 package is installed.
+    The proxy is used only for https, like requests does with {"https": proxy}.
+    """
+    lock: threading.Lock = threading.Lock()
+    clients: Dict[Tuple[str, Optional[str]], httpx.Client] = {}
+    dadata_client: Optional[dadata.Dadata] = None
+    is_http2: bool = importlib.util.find_spec("h2") is not None
+
+    @classmethod
+    def get(cls, url: str, proxy: Optional[str] = None) -> httpx.Client:
+        """
+        Getting the client for the provider of the url.
+        :param url:
+        :param proxy:
+        :return:
+        """
+        provider: str = str(httpx.URL(url).copy_with(path="/", query=None, fragment=None))
+        with cls.lock:
+            if (provider, proxy) not in cls.clients:
+                limits: httpx.Limits = httpx.Limits(keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+                mounts: dict = {
+                    "https://": httpx.HTTPTransport(proxy=proxy, http2=cls.is_http2, limits=limits)
+                } if proxy else {}
+                cls.clients[(provider, proxy)] = httpx.Client(
+                    http2=cls.is_http2, limits=limits, mounts=mounts, timeout=120, follow_redirects=True
+                )
+            return cls.clients[(provider, proxy)]
+
+    @classmethod
+    def get_dadata(cls) -> dadata.Dadata:
+        """
+        Getting the client of DaData. It keeps its connections itself.
+        :return:
+        """
+        with cls.lock:
+            if cls.dadata_client is None:
+                cls.dadata_client = dadata.Dadata(token=DADATA_TOKEN, secret=DADATA_SECRET)
+            return cls.dadata_client
+
+    @classmethod
+    def close(cls) -> None:
+        """
+        Closing all clients.
+        :return:
+        """
+        with cls.lock:
+            for client in cls.clients.values():
+                with contextlib.suppress(Exception):
+                    client.close()
+            cls.clients = {}
+            if cls.dadata_client is not None:
+                with contextlib.suppress(Exception):
+                    cls.dadata_client.close()
+                cls.dadata_client = None
+
+    @classmethod
+    def reset_after_fork(cls) -> None:
+        """
+        Dropping the clients inherited from the parent process without closing them: their sockets belong to it.
+        :return:
+        """
+        cls.lock = threading.Lock()
+        cls.clients = {}
+        cls.dadata_client = None
+
+
+os.register_at_fork(after_in_child=CacheConnection.reset_after_fork)
+os.register_at_fork(after_in_child=HttpClients.reset_after_fork)
+atexit.register(HttpClients.close)
+os.register_at_fork(after_in_child=CompanyCache.reset_after_fork)
 
 
 class UnifiedCompaniesManager:
+    instance: Optional[UnifiedCompaniesManager] = None
+
     def __init__(self):
         self.unified_companies = [
             UnifiedRussianCompanies(),
@@ -33,6 +330,16 @@ class UnifiedCompaniesManager:
             UnifiedUzbekistanCompanies()
         ]
 
+    @classmethod
+    def get_instance(cls) -> UnifiedCompaniesManager:
+        """
+        Getting the manager of the process. The validators keep no state, so they are created once.
+        :return:
+        """
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
     @staticmethod
     def get_valid_company(unified_company, company_data):
         with contextlib.suppress(Exception):
@@ -40,19 +347,46 @@ class UnifiedCompaniesManager:
                 return unified_company
 
     @staticmethod
-    def fetch_company_name(df, company, taxpayer_id):
-        rows = company.cur.execute(
-            f'SELECT * FROM "{company.table_name}" WHERE taxpayer_id=?',
-            (taxpayer_id,)
-        ).fetchall()
-        return rows[0][1] if rows else company.get_company_by_taxpayer_id(df, taxpayer_id, 3)
+    def fetch_company_name(token_index, company, taxpayer_id):
+        row = company.get_cached(taxpayer_id)
+        return row[1] if row else company.get_company_by_taxpayer_id(token_index, taxpayer_id, 3)
+
+    @staticmethod
+    def is_looked_up(company, key: str, result: Optional[str]) -> bool:
+        """
+        Checking whether the lookup got an answer. The registries save "not found" to the cache,
+        so the empty result that is not in the cache means that the lookup failed (e.g. the network error).
+        :param company:
+        :param key:
+        :param result:
+        :return:
+        """
+        return result is not None or company.get_cached(key) is not None
 
 
 class UnifiedContextProcessor:
+    executor: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        """
+        Getting the pool of threads for the lookups of companies. It is created once per process,
+        the modules used by the lookups are loaded before it.
+        :return:
+        """
+        if cls.executor is None:
+            load_modules(*LOOKUP_MODULES)
+            cls.executor = ThreadPoolExecutor(max_workers=COMPANY_LOOKUP_WORKERS, thread_name_prefix="company_lookup")
+        return cls.executor
+
+    @classmethod
+    def reset_after_fork(cls) -> None:
+        cls.executor = None
+
     @staticmethod
-    def unified_values(context: dict, df: DataFrame):
+    def unified_values(context: dict, token_index: WorkbookTokenIndex) -> bool:
         UnifiedContextProcessor.unify_station(context)
-        UnifiedContextProcessor.unify_companies(context, df)
+        return UnifiedContextProcessor.unify_companies(context, token_index)
 
     @staticmethod
     def unify_station(context: dict):
@@ -63,24 +397,128 @@ class UnifiedContextProcessor:
                 break
 
     @staticmethod
-    def unify_companies(context: dict, df: DataFrame):
-        manager = UnifiedCompaniesManager()
-
-        for company in HEADER_LABELS[:4]:
-            if company_data := context.get(company):
-                taxpayer_id, country, is_found_taxpayer_id = \
-                    UnifiedContextProcessor.extract_taxpayer_id(company_data, df)
-                context[f"{company}_taxpayer_id"] = taxpayer_id
-                context[f"is_found_{company}_taxpayer_id_invoice"] = is_found_taxpayer_id
-
-                if taxpayer_id:
-                    for unified_company in manager.unified_companies:
-                        if unified_company := manager.get_valid_company(unified_company, taxpayer_id):
-                            company_name = manager.fetch_company_name(df, unified_company, taxpayer_id)
-                            context[f"{company}_unified"] = company_name
+    def unify_companies(context: dict, token_index: WorkbookTokenIndex):
+        """
+        Unifying the companies of the document. The lookups of different companies run in parallel threads,
+        the same company in several fields is looked up once. The results are set in the order of the fields.
+        :param context:
+        :param token_index:
+        :return: Whether all lookups got an answer.
+        """
+        companies: Dict[str, str] = {
+            company: company_data for company in HEADER_LABELS[:4] if (company_data := context.get(company))
+        }
+        distinct_data: List[str] = list(dict.fromkeys(companies.values()))
+        lookups: Dict[str, Future] = {}
+        if COMPANY_LOOKUP_WORKERS > 1:
+            for company_data in distinct_data[1:]:
+                lookups[company_data] = UnifiedContextProcessor.get_executor().submit(
+                    UnifiedContextProcessor.lookup_company, company_data, token_index
+                )
+        results: Dict[str, tuple] = {}
+        for company, company_data in companies.items():
+            if company_data not in results:
+                if company_data in lookups:
+                    results[company_data] = lookups[company_data].result()
+                else:
+                    results[company_data] = UnifiedContextProcessor.lookup_company(company_data, token_index)
+            taxpayer_id, is_found_taxpayer_id, company_names, _ = results[company_data]
+            context[f"{company}_taxpayer_id"] = taxpayer_id
+            context[f"is_found_{company}_taxpayer_id_invoice"] = is_found_taxpayer_id
+            for company_name in company_names:
+                context[f"{company}_unified"] = company_name
+        return all(result[3] for result in results.values())
+
+    @staticmethod
+    def lookup_company(
+        company_data: str,
+        token_index: WorkbookTokenIndex
+    ) -> Tuple[Optional[str], bool, List[Optional[str]], bool]:
+        """
+        Finding the taxpayer ID of the company and the company names by the registries of the countries it is valid in.
+        :param company_data:
+        :param token_index:
+        :return: Taxpayer ID, whether it is found in the invoice, company names, whether all lookups got an answer.
+        """
+        manager: UnifiedCompaniesManager = UnifiedCompaniesManager.get_instance()
+        taxpayer_id, country, is_found_taxpayer_id = \
+            UnifiedContextProcessor.extract_taxpayer_id(company_data, token_index)
+        search_engine: SearchEngineParser = SearchEngineParser(None)
+        is_complete: bool = manager.is_looked_up(search_engine, search_engine.clean_value(company_data), taxpayer_id)
+        company_names: List[Optional[str]] = []
+        if taxpayer_id:
+            for unified_company in manager.unified_companies:
+                if unified_company := manager.get_valid_company(unified_company, taxpayer_id):
+                    company_name: Optional[str] = manager.fetch_company_name(token_index, unified_company, taxpayer_id)
+                    is_complete &= manager.is_looked_up(unified_company, taxpayer_id, company_name)
+                    company_names.append(company_name)
+        return taxpayer_id, is_found_taxpayer_id, company_names, is_complete
+
+    @staticmethod
+    def prefetch_companies(companies: Dict[str, set]) -> None:
+        """
+        Looking up the companies of all workbooks of the input before they are parsed, so that parsing finds them
+        in the cache. The search results come first, then the registries are asked once for each distinct taxpayer
+        ID. The lookups run in PREFETCH_WORKERS threads. Errors are logged and skipped: the company is looked up
+        again, when the workbook is parsed.
+        :param companies: The company and the digits in the first rows of the workbooks where it is met.
+        :return:
+        """
+        if not companies:
+            return
+        load_modules(*LOOKUP_MODULES)
+        taxpayer_ids: set = set()
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="company_prefetch") as executor:
+            futures: Dict[Future, str] = {
+                executor.submit(UnifiedContextProcessor.prefetch_taxpayer_id, company_data, digit_runs): company_data
+                for company_data, digit_runs in companies.items()
+            }
+            for future, company_data in futures.items():
+                try:
+                    if taxpayer_id := future.result():
+                        taxpayer_ids.add(taxpayer_id)
+                except Exception as exception:
+                    logger.warning(f"Failed to prefetch the taxpayer ID of {company_data}. Exception is {exception}")
+            futures = {
+                executor.submit(UnifiedContextProcessor.prefetch_company_names, taxpayer_id): taxpayer_id
+                for taxpayer_id in taxpayer_ids
+            }
+            for future, taxpayer_id in futures.items():
+                try:
+                    future.result()
+                except Exception as exception:
+                    logger.warning(f"Failed to prefetch the company by INN {taxpayer_id}. Exception is {exception}")
+
+    @staticmethod
+    def prefetch_taxpayer_id(company_data: str, digit_runs: set) -> Optional[str]:
+        """
+        Getting the search results for the company and the taxpayer ID that is likely chosen:
+        the first one met in the workbook, otherwise the most frequent one.
+        :param company_data:
+        :param digit_runs:
+        :return:
+        """
+        search_engine: SearchEngineParser = SearchEngineParser(None)
+        value: str = search_engine.clean_value(company_data)
+        if row := search_engine.get_cached(value):
+            return row[1]
+        api_inn: dict = search_engine.get_search_results(value)
+        return next((inn for inn in api_inn if inn in digit_runs), None) or max(api_inn, key=api_inn.get, default=None)
 
     @staticmethod
-    def extract_taxpayer_id(company_data, df: DataFrame):
+    def prefetch_company_names(taxpayer_id: str) -> None:
+        """
+        Getting the company names for the taxpayer ID from the registries of the countries it is valid in.
+        :param taxpayer_id:
+        :return:
+        """
+        manager: UnifiedCompaniesManager = UnifiedCompaniesManager.get_instance()
+        for unified_company in manager.unified_companies:
+            if unified_company := manager.get_valid_company(unified_company, taxpayer_id):
+                manager.fetch_company_name(None, unified_company, taxpayer_id)
+
+    @staticmethod
+    def extract_taxpayer_id(company_data, token_index: WorkbookTokenIndex):
         valid_company: Optional[object] = None
         # all_digits = re.findall(r"\d+", company_data)
         #
@@ -91,21 +529,29 @@ class UnifiedContextProcessor:
 
         # If no valid taxpayer ID found, use search engine
         search_engine = SearchEngineParser(valid_company)
-        return search_engine.get_company_by_taxpayer_id(df, company_data, 3)
+        return search_engine.get_company_by_taxpayer_id(token_index, company_data, 3)
+
+
+os.register_at_fork(after_in_child=UnifiedContextProcessor.reset_after_fork)
 
 
 class BaseUnifiedCompanies(abc.ABC):
+    table_name: str = "cache_taxpayer_id"
+
     def __init__(self):
-        self.table_name: str = "cache_taxpayer_id"
-        self.conn: sqlite3.Connection = sqlite3.connect(self.create_file_for_cache(), check_same_thread=False)
-        self.cur: sqlite3.Cursor = self.load_cache()
+        self.load_cache()
 
     @abc.abstractmethod
     def is_valid(self, number: str) -> bool:
         pass
 
     @abc.abstractmethod
-    def get_company_by_taxpayer_id(self, df: DataFrame, taxpayer_id: str, number_attempts: int) -> Optional[str]:
+    def get_company_by_taxpayer_id(
+        self,
+        token_index: WorkbookTokenIndex,
+        taxpayer_id: str,
+        number_attempts: int
+    ) -> Optional[str]:
         pass
 
     @staticmethod
@@ -120,20 +566,47 @@ class BaseUnifiedCompanies(abc.ABC):
         fle.touch(exist_ok=True)
         return path_cache
 
-    def load_cache(self) -> sqlite3.Cursor:
+    def load_cache(self) -> None:
         """
         Loading the cache.
         """
-        cur: sqlite3.Cursor = self.conn.cursor()
-        cur.execute(f"""CREATE TABLE IF NOT EXISTS {self.table_name}(
-               taxpayer_id TEXT PRIMARY KEY,
-               company_name TEXT,
-               country TEXT)
-            """)
-        self.conn.commit()
-        return cur
+        CacheConnection.create_table(
+            self.table_name, "taxpayer_id TEXT PRIMARY KEY, company_name TEXT, country TEXT, updated_at REAL"
+        )
+        CacheConnection.add_column(self.table_name, "updated_at REAL", time.time())
+
+    def get_expiry_time(self, company_name: Optional[str], updated_at: float) -> float:
+        """
+        Getting the time, when the row expires. The TTL depends on the country and on whether the company was found.
+        The rows saved before the time of update was recorded get the time, when the column is added.
+        :param company_name:
+        :param updated_at:
+        :return:
+        """
+        ttl, negative_ttl = COMPANY_CACHE_TTL.get(str(self), COMPANY_CACHE_TTL["russia"])
+        return updated_at + (ttl if company_name is not None else negative_ttl)
 
-    def get_response(self, url, country, method="GET", data=None, use_proxy=True) -> Optional[Response]:
+    def get_cached(self, taxpayer_id: str) -> Optional[tuple]:
+        """
+        Getting the row of the cache: taxpayer ID, company name and country. The memory is checked before cache.db.
+        The company name is None, if the company was not found.
+        """
+        memory_cache: CompanyCache = CompanyCache.get_instance(self.table_name)
+        if row := memory_cache.get(taxpayer_id):
+            return row
+        saved_row: Optional[tuple] = CacheConnection.fetch_one(
+            f'SELECT taxpayer_id, company_name, country, updated_at FROM "{self.table_name}" WHERE taxpayer_id=?',
+            (taxpayer_id,)
+        )
+        if not saved_row:
+            return None
+        expires_at: float = self.get_expiry_time(saved_row[1], saved_row[3])
+        if expires_at <= time.time():
+            return None
+        memory_cache.put(taxpayer_id, saved_row[:3], expires_at)
+        return saved_row[:3]
+
+    def get_response(self, url, country, method="GET", data=None, use_proxy=True) -> Optional[httpx.Response]:
         """
         Sending a request to the API.
         :param url:
@@ -143,23 +616,22 @@ class BaseUnifiedCompanies(abc.ABC):
         :param use_proxy:
         :return:
         """
-        response: Optional[Response] = None
+        response: Optional[httpx.Response] = None
         proxy: Optional[str] = next(CYCLED_PROXIES) if use_proxy else None
         used_proxy: Optional[str] = None
         try:
-            session: Session = requests.Session()
+            client: httpx.Client = HttpClients.get(url, proxy)
             if use_proxy:
-                session.proxies = {"https": proxy}
                 used_proxy = proxy
             if method == "POST":
-                response = session.post(url, json=data, timeout=120)
+                response = client.post(url, json=data)
             else:
-                response = session.get(url, timeout=120)
+                response = client.get(url)
             logger.info(f"Статус запроса {response.status_code}. URL - {url}. Country - {country}")
             logger.info(f'Использованный прокси: {used_proxy if use_proxy else "Без прокси"}')
             response.raise_for_status()
             return response
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(
                 f"Ошибка API-запроса - {e}. Proxy - {used_proxy}. Text - {response.text if response else 'No response'}"
             )
@@ -168,13 +640,19 @@ class BaseUnifiedCompanies(abc.ABC):
                 return self.get_response(url, country, method, data, use_proxy=False)
             return None  # Если ошибка без прокси, просто возвращаем None
 
-    def cache_add_and_save(self, taxpayer_id: str, company_name: str, country: str) -> None:
+    def cache_add_and_save(self, taxpayer_id: str, company_name: Optional[str], country: Optional[str]) -> None:
         """
-        Saving and adding the result to the cache.
+        Saving and adding the result to the cache. None as the company name means that the company was not found.
         """
-        self.cur.executemany(f"INSERT or REPLACE INTO {self.table_name} VALUES(?, ?, ?)",
-                             [(taxpayer_id, company_name, country)])
-        self.conn.commit()
+        updated_at: float = time.time()
+        CacheConnection.execute(
+            f"INSERT or REPLACE INTO {self.table_name}(taxpayer_id, company_name, country, updated_at) "
+            f"VALUES(?, ?, ?, ?)",
+            (taxpayer_id, company_name, country, updated_at)
+        )
+        CompanyCache.get_instance(self.table_name).put(
+            taxpayer_id, (taxpayer_id, company_name, country), self.get_expiry_time(company_name, updated_at)
+        )
 
 
 class UnifiedRussianCompanies(BaseUnifiedCompanies):
@@ -216,6 +694,9 @@ class UnifiedRussianCompanies(BaseUnifiedCompanies):
         :param number:
         :return:
         """
+        from stdnum.util import clean, isdigits
+        from stdnum.exceptions import InvalidFormat, InvalidLength, InvalidChecksum
+
         number = clean(number, ' ').strip()
         if not isdigits(number):
             raise InvalidFormat()
@@ -232,37 +713,45 @@ class UnifiedRussianCompanies(BaseUnifiedCompanies):
 
     def is_valid(self, number):
         """Check if the number is a valid ???."""
+        from stdnum.exceptions import ValidationError
+
         try:
             return bool(self.validate(number))
         except ValidationError:
             return False
 
-    def get_company_by_taxpayer_id(self, df: DataFrame, taxpayer_id: str, number_attempts: int) -> Optional[str]:
+    def get_company_by_taxpayer_id(
+        self,
+        token_index: WorkbookTokenIndex,
+        taxpayer_id: str,
+        number_attempts: int
+    ) -> Optional[str]:
         """
         Getting the company name unified from the cache, if there is one.
         Otherwise, we are looking for verification of legal entities on websites.
-        :param df:
+        :param token_index:
         :param taxpayer_id:
         :param number_attempts:
         :return:
         """
-        dadata: DadataClient = DadataClient(token=DADATA_TOKEN, secret=DADATA_SECRET)
+        dadata_client: dadata.Dadata = HttpClients.get_dadata()
         try:
-            dadata_response: list = dadata.find_by_id("party", taxpayer_id)
+            dadata_response: list = dadata_client.find_by_id("party", taxpayer_id)
         except httpx.ConnectError as ex_connect:
             logger.error(f"Failed to connect dadata {ex_connect}. Type error is {type(ex_connect)}. "
                          f"INN is {taxpayer_id}")
             time.sleep(30)
-            dadata_response = dadata.find_by_id("party", taxpayer_id)
+            dadata_response = dadata_client.find_by_id("party", taxpayer_id)
         except Exception as ex_all:
             logger.error(f"Unknown error in dadata {ex_all}. Type error is {type(ex_all)}. INN is {taxpayer_id}")
             return None
         if dadata_response:
             company_name = dadata_response[0].get('value')
             logger.info(f"Company name is {company_name}. INN is {taxpayer_id}")
-            self.cache_add_and_save(taxpayer_id, company_name, self.__str__())
         else:
             company_name = None
+            logger.info(f"Company is not found. INN is {taxpayer_id}")
+        self.cache_add_and_save(taxpayer_id, company_name, self.__str__())
         return company_name
 
 
@@ -290,10 +779,10 @@ class UnifiedKazakhstanCompanies(BaseUnifiedCompanies):
             check_sum = self.multiply(w2, number) % 11
         return check_sum == int(number[-1])
 
-    def get_company_by_taxpayer_id(self, df: DataFrame, taxpayer_id: str, number_attempts: int):
+    def get_company_by_taxpayer_id(self, token_index: WorkbookTokenIndex, taxpayer_id: str, number_attempts: int):
         """
 
-        :param df:
+        :param token_index:
         :param taxpayer_id:
         :param number_attempts:
         :return:
@@ -343,17 +832,20 @@ class UnifiedBelarusCompanies(BaseUnifiedCompanies):
 
         return checksum == int(number[-1])
 
-    def get_company_by_taxpayer_id(self, df: DataFrame, taxpayer_id: str, number_attempts: int):
+    def get_company_by_taxpayer_id(self, token_index: WorkbookTokenIndex, taxpayer_id: str, number_attempts: int):
         """
 
-        :param df:
+        :param token_index:
         :param taxpayer_id:
         :param number_attempts:
         :return:
         """
         if response := self.get_response(f"https://www.portal.nalog.gov.by/grp/getData?unp="
                                          f"{taxpayer_id}&charset=UTF-8&type=json", self.__str__()):
-            row = response.json()['row']
+            if not (row := response.json().get('row')):
+                logger.info(f"Company is not found. UNP is {taxpayer_id}")
+                self.cache_add_and_save(taxpayer_id, None, self.__str__())
+                return None
             data = {'unp': row['vunp'], 'company_name': row['vnaimk']}
             logger.info(f"Company name is {data['company_name']}. UNP is {taxpayer_id}")
             self.cache_add_and_save(taxpayer_id, data['company_name'], self.__str__())
@@ -373,22 +865,22 @@ class UnifiedUzbekistanCompanies(BaseUnifiedCompanies):
     def is_valid(self, number):
         return False if len(number) != 9 else bool(re.match(r'[3-8]', number))
 
-    def get_company_by_taxpayer_id(self, df: DataFrame, taxpayer_id: str, number_attempts: int):
+    def get_company_by_taxpayer_id(self, token_index: WorkbookTokenIndex, taxpayer_id: str, number_attempts: int):
         """
 
-        :param df:
+        :param token_index:
         :param taxpayer_id:
         :param number_attempts:
         :return:
         """
         if response := self.get_response(f"http://orginfo.uz/en/search/all?q={taxpayer_id}", self.__str__()):
-            soup = BeautifulSoup(response.text, "html.parser")
+            soup = bs4.BeautifulSoup(response.text, "html.parser")
             a = soup.find_all('div', class_='card-body pt-0')[-1]
             if name := a.find_next('h6', class_='card-title'):
                 name = name.text.replace('\n', '').strip()
             logger.info(f"Company name is {name}. INN is {taxpayer_id}")
             try:
-                company_name: str = GoogleTranslator(source='uz', target='ru').translate(name[:4500])
+                company_name: str = deep_translator.GoogleTranslator(source='uz', target='ru').translate(name[:4500])
             except Exception as e:
                 logger.error(f"Exception is {e}")
                 company_name = name
@@ -397,12 +889,67 @@ class UnifiedUzbekistanCompanies(BaseUnifiedCompanies):
 
 
 class SearchEngineParser(BaseUnifiedCompanies):
+    table_name: str = "search_engine"
+    results_table_name: str = "search_engine_results"
+
     def __init__(self, unified_company):
         super().__init__()
-        self.table_name = "search_engine"
-        self.cur: sqlite3.Cursor = self.load_cache()
         self.unified_company = unified_company
 
+    def __str__(self):
+        return "search_engine"
+
+    def load_cache(self) -> None:
+        """
+        Loading the cache of the chosen taxpayer IDs and the cache of the search results.
+        """
+        super().load_cache()
+        CacheConnection.create_table(
+            self.results_table_name, "query TEXT PRIMARY KEY, results TEXT, country TEXT, updated_at REAL"
+        )
+
+    @staticmethod
+    def clean_value(value: str) -> str:
+        """
+        Removing the quotes and symbols from the company, it is the key of the caches.
+        """
+        unwanted_chars = r"[<>\«\»\’\‘\“\”`'\".,!@#$%^&*()\[\]{};?\|~=_+]+"
+        value = re.sub(unwanted_chars, "", value)
+        return re.sub(" +", " ", value).strip()
+
+    def get_search_results(self, value: str) -> dict:
+        """
+        Getting the taxpayer IDs found by the search engine with the number of their mentions.
+        The results are cached, so that each workbook chooses the ID by its own content without a new search.
+        The country of the IDs is restored from the cache as well. No results are saved as NULL.
+        """
+        memory_cache: CompanyCache = CompanyCache.get_instance(self.results_table_name)
+        row: Optional[tuple] = memory_cache.get(value)
+        if row is None:
+            saved_row: Optional[tuple] = CacheConnection.fetch_one(
+                f'SELECT query, results, country, updated_at FROM "{self.results_table_name}" WHERE query=?', (value,)
+            )
+            if saved_row and (expires_at := self.get_expiry_time(saved_row[1], saved_row[3])) > time.time():
+                row = saved_row[:3]
+                memory_cache.put(value, row, expires_at)
+        if row is None:
+            dict_inn: dict = self.get_inn_from_search_engine(value)
+            results: Optional[str] = json.dumps(dict_inn) if dict_inn else None
+            row = (value, results, str(self.unified_company) if self.unified_company else None)
+            updated_at: float = time.time()
+            CacheConnection.execute(
+                f"INSERT or REPLACE INTO {self.results_table_name} VALUES(?, ?, ?, ?)", (*row, updated_at)
+            )
+            memory_cache.put(value, row, self.get_expiry_time(results, updated_at))
+            return dict_inn
+        if row[2] and not self.unified_company:
+            self.unified_company = next(
+                (company for company in UnifiedCompaniesManager.get_instance().unified_companies
+                 if str(company) == row[2]),
+                None
+            )
+        return json.loads(row[1]) if row[1] else {}
+
     def is_valid(self, number: str) -> bool:
         pass
 
@@ -436,7 +983,7 @@ class SearchEngineParser(BaseUnifiedCompanies):
             else:
                 raise ConnectionRefusedError(message)
 
-    def parse_xml(self, response: Response, value: str, dict_inn: dict, count_inn: int, unified_companies):
+    def parse_xml(self, response: httpx.Response, value: str, dict_inn: dict, count_inn: int, unified_companies):
         """
         Parsing xml.
         """
@@ -459,47 +1006,21 @@ class SearchEngineParser(BaseUnifiedCompanies):
         """
         logger.info(f"Before request. Data is {value}")
         try:
-            r: Response = requests.get(f"https://xmlriver.com/search_yandex/xml?user={USER_XML_RIVER}"
-                                       f"&key={KEY_XML_RIVER}&query={value} ИНН", timeout=120)
+            url: str = f"https://xmlriver.com/search_yandex/xml?user={USER_XML_RIVER}" \
+                       f"&key={KEY_XML_RIVER}&query={value} ИНН"
+            r: httpx.Response = HttpClients.get(url).get(url)
         except Exception as e:
             logger.error(f"Run time out. Data is {value}. Exception is {e}")
             raise AssertionError from e
         logger.info(f"After request. Data is {value}")
         dict_inn: dict = {}
         count_inn: int = 1
-        unified_companies = [
-            UnifiedRussianCompanies(),
-            UnifiedKazakhstanCompanies(),
-            UnifiedBelarusCompanies(),
-            UnifiedUzbekistanCompanies()
-        ]
+        unified_companies = UnifiedCompaniesManager.get_instance().unified_companies
         self.parse_xml(r, value, dict_inn, count_inn, unified_companies)
         logger.info(f"Dictionary with INN is {dict_inn}. Data is {value}")
         return dict_inn
 
-    @staticmethod
-    def find_key_in_dataframe(df: DataFrame, search_dict: dict):
-        """
-        Define the function to search for a string in the DataFrame
-        :param df:
-        :param search_dict:
-        :return:
-        """
-        def search_string(s, search):
-            return search in str(s).lower()
-
-        for key in search_dict:
-            # Create a mask by applying the search function to check if the key exists
-            mask = df.apply(lambda x: x.map(lambda s: search_string(s, key)))
-
-            # If any value in the mask is True, return the key
-            if mask.any().any():
-                return key
-
-        # If no key is found, return None
-        return None
-
-    def get_company_by_taxpayer_id(self, df: DataFrame, value: str, number_attempts: int):
+    def get_company_by_taxpayer_id(self, token_index: WorkbookTokenIndex, value: str, number_attempts: int):
         """
         Getting the INN from the cache, if there is one. Otherwise, we search in the search engine.
         """
@@ -507,18 +1028,15 @@ class SearchEngineParser(BaseUnifiedCompanies):
         is_found_taxpayer_id_invoice = True
         if number_attempts == 0:
             return best_found_inn, self.unified_company
-        unwanted_chars = r"[<>\«\»\’\‘\“\”`'\".,!@#$%^&*()\[\]{};?\|~=_+]+"
-        value = re.sub(unwanted_chars, "", value)
-        value = re.sub(" +", " ", value).strip()
-        rows: sqlite3.Cursor = self.cur.execute(f'SELECT * FROM "{self.table_name}" WHERE taxpayer_id=?', (value,), )
-        if list_rows := list(rows):
-            logger.info(f"Data is {list_rows[0][0]}. INN is {list_rows[0][1]}")
-            if not self.find_key_in_dataframe(df, {f"{list_rows[0][1]}": 1}):
+        value = self.clean_value(value)
+        if row := self.get_cached(value):
+            logger.info(f"Data is {row[0]}. INN is {row[1]}")
+            if not token_index.find_key({f"{row[1]}": 1}):
                 is_found_taxpayer_id_invoice = False
-            return list_rows[0][1], list_rows[0][2], is_found_taxpayer_id_invoice
+            return row[1], row[2], is_found_taxpayer_id_invoice
         try:
-            api_inn: dict = self.get_inn_from_search_engine(value)
-            best_found_inn = self.find_key_in_dataframe(df, api_inn)
+            api_inn: dict = self.get_search_results(value)
+            best_found_inn = token_index.find_key(api_inn)
             if not best_found_inn:
                 is_found_taxpayer_id_invoice = False
                 best_found_inn = max(api_inn, key=api_inn.get, default=None)
@@ -529,7 +1047,7 @@ class SearchEngineParser(BaseUnifiedCompanies):
             )
         except ConnectionRefusedError:
             time.sleep(60)
-            self.get_company_by_taxpayer_id(df, value, number_attempts - 1)
+            self.get_company_by_taxpayer_id(token_index, value, number_attempts - 1)
         return best_found_inn, self.unified_company, is_found_taxpayer_id_invoice
 
 